@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+
+# options that only affect the speed of a search, or are part of the cache key
+UNKEYED_OPTIONS = ('threads', 'hash', 'multipv', 'uci_variant', 'ponder')
+
+
+def engine_fingerprint(engine_path, options):
+    """Identifier of an engine binary and the options its analysis depends on."""
+    path = shutil.which(engine_path) or engine_path
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except OSError:
+        modified = None
+    return json.dumps([os.path.abspath(path), modified,
+                       sorted((name.lower(), str(value)) for name, value in options.items() if name.lower() not in UNKEYED_OPTIONS)])
+
+
+class AnalysisCache():
+    """Persistent store of engine analysis as returned by uci.Engine.go.
+
+    Entries are keyed by (variant, fen, moves) and served for any request that does not
+    exceed the stored depth and multipv. The least recently used entries are evicted
+    once the store holds more than max_entries positions.
+
+    If an engine fingerprint is given, analysis stored for a different one, e.g., of
+    another network or variant definition, is dropped on open.
+    """
+
+    def __init__(self, path, max_entries=1000000, engine=None):
+        self.max_entries = max_entries
+        self.puts = 0
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS analysis ('
+                                'variant TEXT, fen TEXT, moves TEXT, depth INTEGER, multipv INTEGER, '
+                                'infos TEXT, used REAL, PRIMARY KEY (variant, fen, moves))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS analysis_used ON analysis (used)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)')
+        if engine is not None:
+            self._check_engine(engine)
+
+    def _check_engine(self, engine):
+        # lock before checking so concurrent workers clear the store at most once
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.connection.execute("SELECT value FROM metadata WHERE key='engine'").fetchone()
+            if not row or row[0] != engine:
+                self.connection.execute('DELETE FROM analysis')
+                self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('engine', ?)", (engine,))
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    def get(self, variant, fen, moves, depth, multipv):
+        key = (variant, fen, ' '.join(moves))
+        row = self.connection.execute('SELECT depth, multipv, infos FROM analysis WHERE variant=? AND fen=? AND moves=?', key).fetchone()
+        if not row or row[0] < depth or row[1] < multipv:
+            return None
+        self.connection.execute('UPDATE analysis SET used=? WHERE variant=? AND fen=? AND moves=?', (time.time(),) + key)
+        return [multipv_info[:multipv] for multipv_info in json.loads(row[2])
+                if not multipv_info or multipv_info[0].get('depth', 0) <= depth]
+
+    def put(self, variant, fen, moves, depth, multipv, infos):
+        # never replace deeper analysis by shallower one
+        self.connection.execute('INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (variant, fen, moves) DO UPDATE SET '
+                                'depth=excluded.depth, multipv=excluded.multipv, infos=excluded.infos, used=excluded.used '
+                                'WHERE excluded.depth >= analysis.depth AND excluded.multipv >= analysis.multipv',
+                                (variant, fen, ' '.join(moves), depth, multipv,
+                                 json.dumps(infos, separators=(',', ':')), time.time()))
+        self.puts += 1
+        if self.puts % 1000 == 0:
+            self.evict()
+
+    def evict(self):
+        count = self.connection.execute('SELECT COUNT(*) FROM analysis').fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute('DELETE FROM analysis WHERE rowid IN (SELECT rowid FROM analysis ORDER BY used LIMIT ?)',
+                                    (count - self.max_entries,))
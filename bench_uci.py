@@ -0,0 +1,102 @@
+""" Microbenchmark of the UCI search output parser on recorded engine output """
+
+import argparse
+from collections import defaultdict
+from collections.abc import Iterable
+import timeit
+
+import uci
+
+
+def parse_search_output_generic(lines):
+    """Generic keyword parser uci.Engine.go used before parse_info, kept as reference."""
+    bestmove = None
+    infos = defaultdict(dict)
+    KEYWORDS = {'depth': int, 'seldepth': int, 'multipv': int, 'nodes': int,
+                'nps': int, 'time': int, 'score': list, 'pv': list}
+
+    for line in lines:
+        items = line.split()
+        if not items:
+            continue
+        elif items[0] == 'bestmove':
+            bestmove = items[1]
+        elif items[0] == 'info' and len(items) > 1 and items[1] != 'string' and 'score' in items:
+            key = None
+            values = []
+            info = {}
+            for i in items[1:] + ['']:
+                if not i or i in KEYWORDS:
+                    if key:
+                        if values and not issubclass(KEYWORDS[key], Iterable):
+                            values = values[0]
+                        info[key] = KEYWORDS[key](values)
+                    key = i
+                    values = []
+                else:
+                    values.append(i)
+            infos[info.get('depth')][info.get('multipv', 1)] = info
+    infos = [[infos[d][m] for m in sorted(infos[d].keys())] for d in sorted(infos.keys())]
+    return bestmove, infos
+
+
+def record_output(engine_path, ucioptions, variant, depth, multipv, fens):
+    engine = uci.Engine([engine_path], ucioptions)
+    engine.setoption('UCI_Variant', variant)
+    engine.setoption('multipv', multipv)
+    searches = []
+    for fen in fens:
+        engine.newgame()
+        engine.position(fen)
+        engine.write('go depth {}\n'.format(depth))
+        searches.append(engine.read('bestmove'))
+    return searches
+
+
+def split_searches(lines):
+    searches = [[]]
+    for line in lines:
+        searches[-1].append(line)
+        if line.startswith('bestmove'):
+            searches.append([])
+    return [search for search in searches if search]
+
+
+def benchmark(searches, repeat):
+    line_total = sum(len(search) for search in searches)
+    print('{} searches, {} output lines'.format(len(searches), line_total))
+    for name, parser in (('generic', parse_search_output_generic), ('parse_info', uci.parse_search_output)):
+        seconds = min(timeit.repeat(lambda: [parser(search) for search in searches], number=1, repeat=repeat))
+        print('{:<12}{:>10.1f} ms{:>12.0f} lines/s'.format(name, 1000 * seconds, line_total / seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recorded_output', nargs='?', help='file with recorded engine output of go commands')
+    parser.add_argument('-e', '--engine', help='record the output of this engine instead of reading a file')
+    parser.add_argument('-o', '--ucioptions', type=lambda kv: kv.split("="), action='append', default=[],
+                        help='UCI option as key=value pair. Repeat to add more options.')
+    parser.add_argument('-v', '--variant', default='chess')
+    parser.add_argument('-f', '--fen-file', help='FEN/EPD file with positions to search when recording')
+    parser.add_argument('-d', '--depth', type=int, default=15)
+    parser.add_argument('-m', '--multipv', type=int, default=2)
+    parser.add_argument('-s', '--save', help='write the recorded engine output to this file')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.engine:
+        fens = [None]
+        if args.fen_file:
+            with open(args.fen_file, encoding='utf8') as f:
+                fens = [line.split(';')[0].strip() for line in f if line.strip()]
+        searches = record_output(args.engine, dict(args.ucioptions), args.variant, args.depth, args.multipv, fens)
+        if args.save:
+            with open(args.save, 'w', encoding='utf8') as f:
+                f.writelines(line for search in searches for line in search)
+    elif args.recorded_output:
+        with open(args.recorded_output, encoding='utf8') as f:
+            searches = split_searches(f)
+    else:
+        parser.error('either recorded output or an engine is required')
+
+    benchmark(searches, args.repeat)
@@ -1,14 +1,21 @@
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from functools import partial
 import fileinput
-from math import log
+from itertools import chain, islice
+import math
 import re
 import sys
 
+import numpy as np
 import pyffish
 from tqdm import tqdm
 
+from epdsort import sort_epds
+import parallel
+
 
 def line_count(filename):
     f = open(filename, 'rb')
@@ -16,25 +23,6 @@ def line_count(filename):
     return sum(buf.count(b'\n') for buf in bufgen)
 
 
-def get_sort_key(sort_criteria, epd):
-    annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
-    key = []
-    if sort_criteria:
-        for crit, direction in sort_criteria:
-            val = annotations.get(crit, '')
-            try:
-                v = float(val)
-            except Exception:
-                v = val
-            if direction in ('d', 'desc'):
-                if isinstance(v, (int, float)):
-                    v = -v
-                else:
-                    v = ''.join(chr(255 - ord(c)) for c in str(v))
-            key.append(v)
-    return tuple(key)
-
-
 LAN_REGEX = re.compile(r'([A-Z])?([a-l][0-9]+)[-x]([a-l][0-9]+)')
 
 def parse_lan_move(move):
@@ -52,6 +40,9 @@ def parse_lan_move(move):
         raise ValueError(f"Invalid LAN move format: {move}")
 
 
+SQUARE_REGEX = re.compile(r'([0-9]+)|([A-Za-z])')
+
+
 def fen_to_square_map(fen):
     """
     Converts a FEN string to a mapping of square (e.g., 'e4') to piece (e.g., 'K', 'p', etc.).
@@ -63,77 +54,297 @@ def fen_to_square_map(fen):
     ranks = len(rows)
     for r, row in enumerate(rows):
         file_idx = 0
-        for char in row:
-            if char.isdigit():
-                file_idx += int(char)
-            elif char.isalpha():
+        # empty square counts can have two digits on large boards
+        for empty, char in SQUARE_REGEX.findall(row):
+            if empty:
+                file_idx += int(empty)
+            else:
                 square = chr(ord('a') + file_idx) + str(ranks - r)
                 square_map[square] = char
                 file_idx += 1
     return square_map
 
 
-def deduplicate(instream, outstream, king, sort_criteria=None, board_similarity_threshold=0.8, move_similarity_threshold=0.8, overall_similarity_threshold=0.5, verbosity=0):
-    epds = [epd for epd in instream]
-    if sort_criteria:
-        epds.sort(key=lambda x: get_sort_key(sort_criteria, x))
-
-    patterns = defaultdict(list)
-    unique = list()
-    for epd in tqdm(epds, total=len(epds)):
-        fen = epd.split(';')[0]
-        annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
-        variant = annotations.get('variant')
-        moves = [m for m in annotations.get('pv', '').split(",") if m]
-        final_fen = pyffish.get_fen(variant, fen, moves)
-        pieces = fen_to_square_map(final_fen)
-        board = frozenset(pieces.items())
-
-        # find king
-        side_to_move = final_fen.split()[1]
-        king_piece = king.upper() if side_to_move == 'w' else king.lower()
-        king_squares = "".join([k for k, v in pieces.items() if v == king_piece])
-
-        # Convert PV to LAN
-        lans = pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_LAN)
-        piece, _, to_sq = parse_lan_move(lans[-1])
-        sans = tuple(pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_SAN))
-
-        # Determine mating pattern
-        pattern = f"{piece}-{to_sq}-{king_piece}-{king_squares}"
-
-        # similarity check
-        for puzzle2 in unique:
-            matching_pairs = sum(1 for item in board if item in puzzle2['board'])
-            board_similarity = 2 * matching_pairs / (len(board) + len(puzzle2['board']))
-
-            # Compare SANs from the back
-            min_len = min(len(sans), len(puzzle2['sans']))
-            matching_sans = 0
-            for i in range(1, min_len + 1):
-                if sans[-i] == puzzle2['sans'][-i]:
-                    matching_sans += 1
-            move_similarity = matching_sans / min_len
-
-            overall_similarity = board_similarity * move_similarity
-
-            if (board_similarity > board_similarity_threshold or
-               move_similarity > move_similarity_threshold or
-               overall_similarity > overall_similarity_threshold):
-                if verbosity > 1:
-                    sys.stderr.write(f"Pattern: {pattern}, Board similarity: {board_similarity:.2f}, Move similarity: {move_similarity:.2f}, Overall similarity: {overall_similarity:.2f}\n{epd}{puzzle2['epd']}\n")
-                break
+def puzzle_features(epd, king):
+    """Final board, SAN moves and mating pattern of an EPD puzzle, as used for deduplication."""
+    fen = epd.split(';')[0]
+    annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
+    variant = annotations.get('variant')
+    moves = [m for m in annotations.get('pv', '').split(",") if m]
+    final_fen = pyffish.get_fen(variant, fen, moves)
+    pieces = fen_to_square_map(final_fen)
+    board = frozenset(pieces.items())
+
+    # find king
+    side_to_move = final_fen.split()[1]
+    king_piece = king.upper() if side_to_move == 'w' else king.lower()
+    king_squares = "".join([k for k, v in pieces.items() if v == king_piece])
+
+    # Convert PV to LAN
+    lans = pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_LAN)
+    piece, _, to_sq = parse_lan_move(lans[-1])
+    sans = tuple(pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_SAN))
+
+    # Determine mating pattern
+    pattern = f"{piece}-{to_sq}-{king_piece}-{king_squares}"
+    return {'epd': epd, 'board': board, 'sans': sans, 'pattern': pattern}
+
+
+# number of puzzles sent to a worker process at once
+FEATURE_BATCH = 64
+
+
+def _batch_features(king, epds):
+    return [puzzle_features(epd, king) for epd in epds]
+
+
+def extract_features(epds, king, executor=None, workers=1):
+    """Yield the puzzle_features of epds in order, computed on executor if given."""
+    if not executor:
+        yield from (puzzle_features(epd, king) for epd in epds)
+        return
+    epds = iter(epds)
+    batches = iter(lambda: list(islice(epds, FEATURE_BATCH)), [])
+    for batch in parallel.imap(executor, partial(_batch_features, king), batches, 4 * workers):
+        yield from batch
+
+
+def similarity(puzzle, puzzle2):
+    """Board, move and overall similarity of two puzzles."""
+    matching_pairs = len(puzzle['board'] & puzzle2['board'])
+    board_similarity = 2 * matching_pairs / (len(puzzle['board']) + len(puzzle2['board']))
+
+    # Compare SANs from the back
+    sans, sans2 = puzzle['sans'], puzzle2['sans']
+    min_len = min(len(sans), len(sans2))
+    matching_sans = sum(1 for i in range(1, min_len + 1) if sans[-i] == sans2[-i])
+    move_similarity = matching_sans / min_len if min_len else 0
+
+    return board_similarity, move_similarity, board_similarity * move_similarity
+
+
+# tolerance making the index err on the side of more candidates despite rounding
+EPSILON = 1e-9
+
+
+def board_prefix_length(size, threshold):
+    """Number of leading board features two boards above the board similarity threshold share one of."""
+    if threshold >= 1:
+        return 0
+    # the Dice coefficient exceeds threshold only with more than this many common pieces
+    min_overlap = math.floor(threshold * size / (2 - threshold) - EPSILON) + 1
+    return min(size, size - min_overlap + 1)
+
+
+def move_prefix_length(size, threshold):
+    """Number of last moves two SAN sequences above the move similarity threshold agree on one of."""
+    if threshold >= 1:
+        return 0
+    return min(size, size - math.floor(threshold * size - EPSILON))
+
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        return POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1)
+
+
+class BoardMatrix():
+    """Boards as rows of a bit matrix with one bit per (square, piece) feature.
+
+    Bits are assigned to features as they are first seen, so the width only depends on
+    the number of distinct features, whatever the board size and piece set.
+    """
+
+    def __init__(self):
+        self.bits = {}
+        self.rows = np.zeros((64, 1), dtype=np.uint64)
+        self.sizes = np.zeros(64, dtype=np.int64)
+        self.count = 0
+
+    def encode(self, board, add=False):
+        """Bit row of board, ignoring features no stored board has unless add is set."""
+        if add:
+            for feature in board:
+                self.bits.setdefault(feature, len(self.bits))
+            while len(self.bits) > 64 * self.rows.shape[1]:
+                self.rows = np.hstack([self.rows, np.zeros_like(self.rows)])
+        row = np.zeros(self.rows.shape[1], dtype=np.uint64)
+        for feature in board:
+            bit = self.bits.get(feature)
+            if bit is not None:
+                row[bit >> 6] |= np.uint64(1 << (bit & 63))
+        return row
+
+    def add(self, board):
+        row = self.encode(board, add=True)
+        if self.count == len(self.rows):
+            self.rows = np.vstack([self.rows, np.zeros_like(self.rows)])
+            self.sizes = np.concatenate([self.sizes, np.zeros_like(self.sizes)])
+        self.rows[self.count] = row
+        self.sizes[self.count] = len(board)
+        self.count += 1
+
+    def similarity(self, board, rows):
+        """Board similarities of board with the stored boards at rows."""
+        matching_pairs = popcount(self.rows[rows] & self.encode(board)).sum(axis=1)
+        return 2 * matching_pairs / (len(board) + self.sizes[rows])
+
+
+class MoveMatrix():
+    """SAN sequences as rows of move ids, aligned from the last move."""
+
+    def __init__(self):
+        self.ids = {}
+        self.rows = np.full((64, 8), -1, dtype=np.int32)
+        self.lengths = np.zeros(64, dtype=np.int64)
+        self.count = 0
+
+    def encode(self, sans, add=False):
+        if add:
+            for san in sans:
+                self.ids.setdefault(san, len(self.ids))
+        # unknown moves get -2, which matches neither stored ids nor the -1 padding
+        return np.array([self.ids.get(san, -2) for san in reversed(sans)], dtype=np.int32)
+
+    def add(self, sans):
+        row = self.encode(sans, add=True)
+        if len(row) > self.rows.shape[1]:
+            self.rows = np.hstack([self.rows, np.full((len(self.rows), len(row) - self.rows.shape[1]), -1, dtype=np.int32)])
+        if self.count == len(self.rows):
+            self.rows = np.vstack([self.rows, np.full_like(self.rows, -1)])
+            self.lengths = np.concatenate([self.lengths, np.zeros_like(self.lengths)])
+        self.rows[self.count, :len(row)] = row
+        self.lengths[self.count] = len(row)
+        self.count += 1
+
+    def similarity(self, sans, rows):
+        """Move similarities of sans with the stored SAN sequences at rows."""
+        row = self.encode(sans)
+        width = min(len(row), self.rows.shape[1])
+        min_len = np.minimum(len(row), self.lengths[rows])
+        matching = (self.rows[rows, :width] == row[:width]) & (np.arange(width) < min_len[:, None])
+        # puzzles without moves have no move similarity
+        return np.divide(matching.sum(axis=1), min_len, out=np.zeros(len(min_len)), where=min_len > 0)
+
+
+class SimilarityIndex():
+    """Kept puzzles, indexed to find the first one similar to a new puzzle.
+
+    Boards are indexed by a prefix of their pieces in order of rank, e.g., rarity, and SAN
+    sequences by their last moves, such that a similar puzzle always shares an indexed
+    feature with the new one (prefix filtering). Only such candidates are compared, which
+    gives the same result as comparing with all kept puzzles. Their similarities are computed
+    at once on bit matrices of boards and matrices of moves.
+    """
+
+    def __init__(self, board_threshold, move_threshold, overall_threshold, rank=None):
+        self.thresholds = (board_threshold, move_threshold, overall_threshold)
+        self.rank = rank
+        self.puzzles = []
+        self.boards = defaultdict(list)
+        self.moves = defaultdict(list)
+        # the overall similarity is exceeded only if both other similarities are as well
+        self.board_threshold = min(board_threshold, overall_threshold)
+        self.move_threshold = min(move_threshold, overall_threshold)
+        self.board_matrix = BoardMatrix()
+        self.move_matrix = MoveMatrix()
+
+    def __len__(self):
+        return len(self.puzzles)
+
+    def _board_features(self, puzzle, threshold):
+        board = sorted(puzzle['board'], key=self.rank)
+        return board[:board_prefix_length(len(board), threshold)]
+
+    def _move_features(self, puzzle, threshold):
+        sans = puzzle['sans']
+        return [(i, sans[-i]) for i in range(1, move_prefix_length(len(sans), threshold) + 1)]
+
+    def _candidates(self, index, features):
+        return {i for feature in features for i in index.get(feature, ())}
+
+    def add(self, puzzle):
+        for feature in self._board_features(puzzle, self.board_threshold):
+            self.boards[feature].append(len(self.puzzles))
+        for feature in self._move_features(puzzle, self.move_threshold):
+            self.moves[feature].append(len(self.puzzles))
+        self.board_matrix.add(puzzle['board'])
+        self.move_matrix.add(puzzle['sans'])
+        self.puzzles.append(puzzle)
+
+    def find(self, puzzle):
+        """Return the first kept puzzle exceeding a similarity threshold with its similarities, or None."""
+        board_threshold, move_threshold, overall_threshold = self.thresholds
+        if min(self.thresholds) < 0:
+            # everything is similar
+            candidates = np.arange(len(self.puzzles))
+        else:
+            candidates = np.array(sorted(self._candidates(self.boards, self._board_features(puzzle, board_threshold))
+                                         | self._candidates(self.moves, self._move_features(puzzle, move_threshold))
+                                         | (self._candidates(self.boards, self._board_features(puzzle, overall_threshold))
+                                            & self._candidates(self.moves, self._move_features(puzzle, overall_threshold)))),
+                                  dtype=np.intp)
+        if not len(candidates):
+            return None
+        board_similarity = self.board_matrix.similarity(puzzle['board'], candidates)
+        move_similarity = self.move_matrix.similarity(puzzle['sans'], candidates)
+        overall_similarity = board_similarity * move_similarity
+        similar = ((board_similarity > board_threshold) | (move_similarity > move_threshold)
+                   | (overall_similarity > overall_threshold))
+        if not similar.any():
+            return None
+        i = similar.argmax()
+        return self.puzzles[candidates[i]], (float(board_similarity[i]), float(move_similarity[i]), float(overall_similarity[i]))
+
+
+# number of puzzles the rarity of board features is estimated from
+RANK_SAMPLE = 1000
+
+
+def rarity_rank(puzzles):
+    """Order of board features by their frequency in puzzles, unseen ones first."""
+    frequency = Counter(feature for puzzle in puzzles for feature in puzzle['board'])
+    return lambda feature: (frequency[feature], feature)
+
+
+def deduplicate(instream, outstream, king, sort_criteria=None, board_similarity_threshold=0.8, move_similarity_threshold=0.8, overall_similarity_threshold=0.5, verbosity=0, total=None, chunk_size=100000, workers=1):
+    """Write the puzzles of instream that are not similar to an earlier one and have a new mating pattern.
+
+    Input is streamed, sorting it first uses temporary files beyond chunk_size lines.
+    Puzzle features are extracted by workers processes, only the comparison is serial.
+    """
+    epds = sort_epds(instream, sort_criteria, chunk_size) if sort_criteria else instream
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        _deduplicate(extract_features(epds, king, executor, workers), outstream, board_similarity_threshold,
+                     move_similarity_threshold, overall_similarity_threshold, verbosity, total)
+
+
+def _deduplicate(puzzles, outstream, board_similarity_threshold, move_similarity_threshold, overall_similarity_threshold, verbosity, total):
+    sample = list(islice(puzzles, RANK_SAMPLE))
+    unique = SimilarityIndex(board_similarity_threshold, move_similarity_threshold, overall_similarity_threshold, rarity_rank(sample))
+    patterns = Counter()
+    for puzzle in tqdm(chain(sample, puzzles), total=total):
+        epd, pattern = puzzle['epd'], puzzle['pattern']
+        match = unique.find(puzzle)
+        if match:
+            if verbosity > 1:
+                puzzle2, (board_similarity, move_similarity, overall_similarity) = match
+                sys.stderr.write(f"Pattern: {pattern}, Board similarity: {board_similarity:.2f}, Move similarity: {move_similarity:.2f}, Overall similarity: {overall_similarity:.2f}\n{epd}{puzzle2['epd']}\n")
         else:
             if pattern not in patterns:
                 # If this is the first occurrence of the pattern, write it
                 outstream.write(epd)
-                unique.append({'board': board, 'sans': sans, 'epd': epd})
-            patterns[pattern].append(epd)
+                unique.add(puzzle)
+            patterns[pattern] += 1
 
     if verbosity:
-        for pattern, epd_list in sorted(patterns.items(), key=lambda x: len(x[1]), reverse=True):
-            if len(epd_list) > 1:
-                sys.stderr.write(f"{pattern}: {len(epd_list)} -> 1\n")
+        for pattern, count in sorted(patterns.items(), key=lambda x: x[1], reverse=True):
+            if count > 1:
+                sys.stderr.write(f"{pattern}: {count} -> 1\n")
 
 
 if __name__ == '__main__':
@@ -146,13 +357,19 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--move-similarity', type=float, default=0.8, help='Similarity threshold for SAN deduplication (default: 0.8)')
     parser.add_argument('-o', '--overall-similarity', type=float, default=0.5, help='Similarity threshold for the product of board and move similarity (default: 0.5)')
     parser.add_argument('-v', '--verbosity', type=int, default=0, help='Enable verbose output for similarity checks')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='maximum number of lines sorted in memory at once (default: 100000)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes extracting puzzle features (default: 1)')
     args = parser.parse_args()
 
+    total = sum(line_count(filename) for filename in args.epd_files) if args.epd_files and '-' not in args.epd_files else None
     with fileinput.input(args.epd_files) as instream:
         deduplicate(
             instream, sys.stdout, args.king, args.sort,
             board_similarity_threshold=args.board_similarity,
             move_similarity_threshold=args.move_similarity,
             overall_similarity_threshold=args.overall_similarity,
-            verbosity=args.verbosity
+            verbosity=args.verbosity,
+            total=total,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
         )
@@ -0,0 +1,83 @@
+""" Sorts EPD files by annotations with bounded memory using an external merge sort """
+
+import argparse
+from contextlib import ExitStack
+import fileinput
+from functools import partial
+import heapq
+from itertools import islice
+import sys
+import tempfile
+
+
+DESCENDING = ('d', 'desc')
+# maximum number of temporary files merged at once
+MAX_RUNS = 256
+
+
+def sort_key(sort_criteria, epd):
+    """Key sorting EPD lines by the values of the annotations in sort_criteria.
+
+    sort_criteria is a list of (annotation, direction) pairs with direction asc/desc/a/d.
+    Numeric values sort before text, e.g., missing annotations, in either direction.
+    """
+    annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
+    key = []
+    for crit, direction in sort_criteria:
+        val = annotations.get(crit, '')
+        descending = direction in DESCENDING
+        try:
+            num = float(val)
+        except ValueError:
+            # a terminator above all negated characters puts longer strings with the same prefix first
+            key.append((1, tuple(-ord(c) for c in val) + (1,) if descending else val))
+        else:
+            key.append((0, -num if descending else num))
+    return tuple(key)
+
+
+def _write_run(lines):
+    run = tempfile.TemporaryFile('w+', encoding='utf8')
+    run.writelines(lines)
+    run.seek(0)
+    return run
+
+
+def sort_epds(lines, sort_criteria, chunk_size=100000):
+    """Yield lines sorted by sort_key, keeping at most chunk_size lines in memory.
+
+    Larger inputs are sorted in chunks written to temporary files, which are then merged.
+    The sort is stable, so lines with equal keys keep their input order.
+    """
+    key = partial(sort_key, sort_criteria)
+    # keep lines separate when runs are concatenated, even if the input lacks a final newline
+    lines = (line if line.endswith('\n') else line + '\n' for line in lines)
+    with ExitStack() as stack:
+        runs = []
+        while True:
+            chunk = sorted(islice(lines, chunk_size), key=key)
+            if not runs and len(chunk) < chunk_size:
+                yield from chunk
+                return
+            if not chunk:
+                break
+            runs.append(stack.enter_context(_write_run(chunk)))
+        while len(runs) > MAX_RUNS:
+            # merge neighbouring runs first to stay within file limits and keep the sort stable
+            groups = [runs[i:i + MAX_RUNS] for i in range(0, len(runs), MAX_RUNS)]
+            runs = [stack.enter_context(_write_run(heapq.merge(*group, key=key))) for group in groups]
+            for run in (run for group in groups for run in group):
+                run.close()
+        yield from heapq.merge(*runs, key=key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('epd_files', nargs='*')
+    parser.add_argument('-s', '--sort', type=lambda kv: kv.split("="), action='append', default=[], required=True,
+                        help='Sorting criteria as key=value pair. value=asc/desc/a/d. Repeat to add more criteria.')
+    parser.add_argument('-c', '--chunk-size', type=int, default=100000, help='maximum number of lines sorted in memory at once')
+    args = parser.parse_args()
+
+    with fileinput.input(args.epd_files, encoding='utf8') as instream:
+        sys.stdout.writelines(sort_epds(instream, args.sort, args.chunk_size))
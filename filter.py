@@ -1,11 +1,15 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import fileinput
 from functools import partial
+import os
 import sys
 
 from tqdm import tqdm
 import pyffish
 
+import parallel
+
 
 def line_count(filename):
     f = open(filename, 'rb')
@@ -39,20 +43,113 @@ def final_net_material(piece_values, fen, annotations):
     return net_material(piece_values, fen)
 
 
-def filter(annotations, min, max, values):
-    for k, v in min.items():
-        if k == 'pv':
-            if len(annotations.get(k, '').split(',')) < int(v):
+def make_inferred_annotations(piece_values):
+    """Functions computing annotations from the FEN and the annotations of a puzzle."""
+    return {
+        'material': lambda fen, annotations: net_material(piece_values, fen),
+        'finalmaterial': lambda fen, annotations: -final_net_material(piece_values, fen, annotations),
+        'materialdiff': lambda fen, annotations: annotations['finalmaterial'] - annotations['material'],
+    }
+
+
+class Annotations(dict):
+    """Annotations of a puzzle, with inferred annotations computed on first access.
+
+    Inferred annotations replace given ones of the same name and can use each other.
+    """
+
+    def __init__(self, fen, annotations, inferred_annotations):
+        super().__init__((k, v) for k, v in annotations.items() if k not in inferred_annotations)
+        self.fen = fen
+        self.inferred_annotations = inferred_annotations
+
+    def __missing__(self, key):
+        if key not in self.inferred_annotations:
+            raise KeyError(key)
+        value = self[key] = self.inferred_annotations[key](self.fen, self)
+        return value
+
+    def get(self, key, default=None):
+        # errors computing inferred annotations, e.g., of missing dependencies, propagate
+        if key in self or key in self.inferred_annotations:
+            return self[key]
+        return default
+
+
+# annotations the inferred annotations are computed from, besides the FEN
+INFERRED_DEPENDENCIES = ('variant', 'pv')
+
+
+def annotation_values(line, keys):
+    """Values of the annotations keys of a stripped EPD line, without parsing the others."""
+    values = {}
+    for key in keys:
+        # the last occurrence wins like in a dict of all annotations
+        start = line.rfind(';' + key + ' ')
+        if start >= 0:
+            start += len(key) + 2
+            end = line.find(';', start)
+            values[key] = line[start:end] if end >= 0 else line[start:]
+    return values
+
+
+class Criteria():
+    """Minimum, maximum and value criteria compiled into a predicate rejecting EPD lines.
+
+    Bounds are parsed once and checks run cheapest first: value sets, numbers, PV lengths,
+    and finally inferred annotations. Missing annotations count as 0 for bounds and as
+    not matching for value sets, and a missing PV has length 1.
+    """
+
+    def __init__(self, min, max, values, inferred_annotations):
+        self.inferred_annotations = inferred_annotations
+        checks = []
+        for k, v in values.items():
+            checks.append((0, k, 0, partial(self._not_in, frozenset(v.split(',')))))
+        for k, v in min.items():
+            if k == 'pv':
+                checks.append((2, k, '', partial(self._too_short, int(v))))
+            else:
+                checks.append((1, k, 0, partial(self._below, float(v))))
+        for k, v in max.items():
+            checks.append((1, k, 0, partial(self._above, float(v))))
+        inferred = list(inferred_annotations)
+
+        def cost(check):
+            # inferred annotations are the most expensive, in the order they are defined
+            return 3 + inferred.index(check[1]) if check[1] in inferred else check[0]
+
+        self.checks = [check[1:] for check in sorted(checks, key=cost)]
+        self.keys = {k for _, k, _, _ in checks}
+        self.inferred = bool(self.keys & set(inferred))
+        if self.inferred:
+            self.keys.update(INFERRED_DEPENDENCIES)
+
+    @staticmethod
+    def _not_in(allowed, value):
+        return value not in allowed
+
+    @staticmethod
+    def _too_short(length, value):
+        return len(value.split(',')) < length
+
+    @staticmethod
+    def _below(bound, value):
+        return float(value) < bound
+
+    @staticmethod
+    def _above(bound, value):
+        return float(value) > bound
+
+    def rejects(self, epd):
+        line = epd.strip()
+        annotations = annotation_values(line, self.keys)
+        if self.inferred:
+            annotations = Annotations(line.split(';')[0], annotations, self.inferred_annotations)
+        for key, default, reject in self.checks:
+            if reject(annotations.get(key, default)):
                 return True
-        elif float(annotations.get(k, 0)) < float(v):
-            return True
-    for k, v in max.items():
-        if float(annotations.get(k, 0)) > float(v):
-            return True
-    for k, v in values.items():
-        if annotations.get(k, 0) not in v.split(','):
-            return True
-    return False
+        return False
 
 
 def filter_puzzles(instream, outstream, min, max, values, inferred_annotations):
@@ -64,15 +161,46 @@ def filter_puzzles(instream, outstream, min, max, values, inferred_annotations):
     # When reading from sys.stdin, filename() is "-"
     total = None if filenames[0] == "-" else sum(line_count(filename) for filename in filenames)
 
+    criteria = Criteria(min, max, values, inferred_annotations)
     for epd in tqdm(instream, total=total):
-        fen = epd.split(';')[0]
-        annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
-        for k, v in inferred_annotations.items():
-            annotations[k] = v(fen, annotations)
-        if not filter(annotations, min, max, values):
+        if not criteria.rejects(epd):
             outstream.write(epd)
 
 
+def file_chunks(filenames, chunk_size):
+    """(filename, start, end) byte ranges splitting the files into chunks of about chunk_size bytes."""
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        for start in range(0, size, chunk_size):
+            yield filename, start, min(start + chunk_size, size)
+
+
+def _filter_chunk(min, max, values, piece_values, chunk):
+    """Lines of a byte range that pass the filter, for those starting inside the range."""
+    filename, start, end = chunk
+    criteria = Criteria(min, max, values, make_inferred_annotations(piece_values))
+    lines = []
+    with open(filename, 'rb') as f:
+        if start:
+            # the line running into the range belongs to the previous one
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            epd = f.readline().decode('utf8')
+            if not criteria.rejects(epd):
+                lines.append(epd)
+    return lines
+
+
+def filter_files(filenames, outstream, min, max, values, piece_values, workers, chunk_size=1 << 24):
+    """Like filter_puzzles, but filters byte ranges of the files in workers processes."""
+    chunks = list(file_chunks(filenames, chunk_size))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = parallel.imap(executor, partial(_filter_chunk, min, max, values, piece_values), chunks, 2 * workers)
+        for lines in tqdm(results, total=len(chunks), unit='chunk'):
+            outstream.writelines(lines)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('epd_files', nargs='*')
@@ -84,17 +212,16 @@ if __name__ == '__main__':
                         help='Set as comma separated list in key=value1,value2 pair. Repeat to add more options.')
     parser.add_argument('-p', '--piece-values', nargs='+', action='append', default=[],
                         help='Piece values mapping, e.g. P=1 N=3 B=3 R=5 Q=9')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes filtering chunks of the input files')
+    parser.add_argument('--chunk-size', type=int, default=1 << 24, help='size of the input chunks in bytes for --workers (default: 16 MiB)')
     args = parser.parse_args()
     try:
         piece_values_dict = {k.lower(): int(v) for k, v in (item.split('=') for sublist in args.piece_values for item in sublist)}
     except Exception as e:
         parser.error(f"Error parsing --piece-values: {e}")
 
-    inferred_annotations = {
-        'material': lambda fen, annotations: net_material(piece_values_dict, fen),
-        'finalmaterial': lambda fen, annotations: -final_net_material(piece_values_dict, fen, annotations),
-        'materialdiff': lambda fen, annotations: -final_net_material(piece_values_dict, fen, annotations) - net_material(piece_values_dict, fen),
-    }
-
-    with fileinput.input(args.epd_files) as instream:
-        filter_puzzles(instream, sys.stdout, dict(args.min), dict(args.max), dict(args.values), inferred_annotations)
+    if args.workers > 1 and args.epd_files and '-' not in args.epd_files:
+        filter_files(args.epd_files, sys.stdout, dict(args.min), dict(args.max), dict(args.values), piece_values_dict, args.workers, args.chunk_size)
+    else:
+        with fileinput.input(args.epd_files) as instream:
+            filter_puzzles(instream, sys.stdout, dict(args.min), dict(args.max), dict(args.values), make_inferred_annotations(piece_values_dict))
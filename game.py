@@ -0,0 +1,35 @@
+import pyffish as sf
+
+
+class GameState():
+    """Current position of a game played through pyffish.
+
+    pyffish replays all moves from the start position on every call, so the position
+    is re-based on the current FEN after each irreversible move (halfmove clock 0).
+    Only the moves since then are replayed, which keeps repetition detection intact.
+    In variants with pockets, captured pieces go into hand and positions can repeat
+    across captures, so the full game is replayed there.
+    """
+
+    def __init__(self, variant, fen, moves=()):
+        self.variant = variant
+        # normalized like the positions after moves
+        self.fen = self.base_fen = sf.get_fen(variant, fen, [])
+        self.moves = []
+        for move in moves:
+            self.push(move)
+
+    def push(self, move):
+        self.moves.append(move)
+        self.fen = sf.get_fen(self.variant, self.base_fen, self.moves)
+        fields = self.fen.split(' ')
+        # the FENs returned by pyffish always show the pockets of variants with drops
+        if fields[-2] == '0' and '[' not in fields[0]:
+            self.base_fen = self.fen
+            self.moves = []
+
+    def legal_moves(self):
+        return sf.legal_moves(self.variant, self.base_fen, self.moves)
+
+    def is_optional_game_end(self):
+        return sf.is_optional_game_end(self.variant, self.base_fen, self.moves)[0]
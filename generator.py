@@ -1,20 +1,71 @@
 import argparse
+import itertools
+import json
 import os
 import random
+import re
 import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 from typing import Callable, Dict, Optional
 
 from tqdm import tqdm
 import pyffish as sf
 
+from game import GameState
+import parallel
+from seen import HashSet, seen_set
 import uci
 
 
 ProgressCallback = Optional[Callable[[int, int], None]]
 
 
-def generate_fens(engine, variant, min_depth, max_depth, add_move, required_pieces, fen_list=None):
+MOVE_SOURCES = ('engine', 'pv', 'random')
+SQUARE = re.compile(r'[a-z][0-9]+')
+CAPTURE_WEIGHT = 4
+
+
+def occupied_squares(fen):
+    """Set of the occupied squares of a FEN, e.g., {'a1', 'e8'}."""
+    ranks = fen.split(' ')[0].split('[')[0].split('/')
+    squares = set()
+    for i, rank in enumerate(ranks):
+        file = 0
+        for empty, piece in re.findall(r'([0-9]+)|([A-Za-z*])', rank):
+            if empty:
+                file += int(empty)
+            else:
+                squares.add('{}{}'.format(chr(ord('a') + file), len(ranks) - i))
+                file += 1
+    return squares
+
+
+def random_move(game, legal_moves, rng=random):
+    """Random legal move, preferring captures to get more tactical positions."""
+    occupied = occupied_squares(game.fen)
+    weights = [CAPTURE_WEIGHT if '@' not in move and SQUARE.findall(move)[-1] in occupied else 1
+               for move in legal_moves]
+    return rng.choices(legal_moves, weights)[0]
+
+
+def select_moves(move_source, engine, game, legal_moves, min_depth, max_depth, rng=random):
+    """Next moves to play, a whole principal variation for the pv move source."""
+    if move_source == 'random':
+        return [random_move(game, legal_moves, rng)]
+    engine.position(game.base_fen, game.moves)
+    bestmove, infos = engine.go(depth=rng.randint(min_depth, max_depth))
+    pv = infos[-1][0].get('pv') if move_source == 'pv' and infos and infos[-1] else None
+    return pv if pv and pv[0] == bestmove else [bestmove]
+
+
+def generate_fens(engine, variant, min_depth, max_depth, add_move, required_pieces, fen_list=None, seen=None, move_source='engine',
+                  rng=random, count=None):
+    """Yield distinct (fen, move) pairs from self-play, remembered in seen (unbounded by default).
+
+    Moves are chosen by an engine search per ply, by playing out the principal variation of
+    each search (pv) or by a capture weighted random choice without engine (random).
+    If count is given, stop after the game in which count positions were reached.
+    """
     if variant not in sf.variants():
         raise Exception("Unsupported variant: {}".format(variant))
 
@@ -23,94 +74,147 @@ def generate_fens(engine, variant, min_depth, max_depth, add_move, required_piec
     else:
         fen_choices = [sf.start_fen(variant)]
 
-    engine.setoption('UCI_Variant', variant)
-
-    fens = set()
-    while True:
-        start_fen = random.choice(fen_choices)
-        engine.newgame()
-        move_stack = []
-        while (sf.legal_moves(variant, start_fen, move_stack)
-               and not sf.is_optional_game_end(variant, start_fen, move_stack)[0]):
-            engine.position(start_fen, move_stack)
-            bestmove, _ = engine.go(depth=random.randint(min_depth, max_depth))
-            move_stack.append(bestmove)
+    if engine:
+        engine.setoption('UCI_Variant', variant)
+
+    fens = HashSet() if seen is None else seen
+    generated = 0
+    while count is None or generated < count:
+        start_fen = rng.choice(fen_choices)
+        if engine:
+            engine.newgame()
+        game = GameState(variant, start_fen)
+        planned = []
+        while True:
+            legal_moves = game.legal_moves()
+            if not legal_moves or game.is_optional_game_end():
+                break
+            if not planned:
+                planned = select_moves(move_source, engine, game, legal_moves, min_depth, max_depth, rng)
+            bestmove = planned.pop(0)
+            fen = game.fen
+            game.push(bestmove)
             if not add_move:
-                fen = sf.get_fen(variant, start_fen, move_stack)
+                fen = game.fen
                 bestmove = None
-            else:
-                fen = sf.get_fen(variant, start_fen, move_stack[:-1])
-            if (fen, bestmove) not in fens and (not required_pieces or any(p in fen.split(' ')[0].lower() for p in required_pieces.lower())):
-                fens.add((fen, bestmove))
+            key = '{} {}'.format(fen, bestmove)
+            if key not in fens and (not required_pieces or any(p in fen.split(' ')[0].lower() for p in required_pieces.lower())):
+                fens.add(key)
+                generated += 1
                 yield fen, bestmove
 
 
-def generate_fens_worker(engine_path, ucioptions, variant, min_depth, max_depth, add_move, required_pieces, count, fen_list=None):
-    engine = uci.Engine([engine_path], ucioptions)
-    generator = generate_fens(engine, variant, min_depth, max_depth, add_move, required_pieces, fen_list)
-    results = []
-    for _ in range(count):
-        results.append(next(generator))
-    return results
+_worker = {}
+
 
+def _init_worker(engine_path, ucioptions, variant, min_depth, max_depth, add_move, required_pieces, fen_list=None, move_source='engine',
+                 seed=0, batch_size=100):
+    sf.set_option("VariantPath", ucioptions.get("VariantPath", ""))
+    engine = uci.Engine([engine_path], ucioptions) if move_source != 'random' else None
+    _worker.update(engine=engine, args=(variant, min_depth, max_depth, add_move, required_pieces, fen_list),
+                   move_source=move_source, seed=seed, batch_size=batch_size)
 
-def write_fens_parallel(stream, engine_path, ucioptions, variant, count, min_depth, max_depth, add_move, required_pieces, workers, fen_list=None, progress_callback: ProgressCallback = None):
-    batch_size = 1000
-    total_batches = (count + batch_size - 1) // batch_size
-    submitted = 0
+
+def generate_batch(batch):
+    """Generate the positions of a batch with the engine of this worker process.
+
+    Each batch plays whole games from a random stream seeded by seed and batch number,
+    so its positions do not depend on which worker runs it. Batches only drop repeats
+    within themselves, repeats across batches are dropped by the seen set of the writer.
+    """
+    rng = random.Random('{}:{}'.format(_worker['seed'], batch))
+    return list(generate_fens(_worker['engine'], *_worker['args'], move_source=_worker['move_source'],
+                              rng=rng, count=_worker['batch_size']))
+
+
+def position_key(fen, move):
+    return '{} {}'.format(fen, move)
+
+
+def read_positions(path):
+    """Yield the (fen, move) pairs of a position file written by the generator."""
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            tokens = line.strip().split(';')
+            annotations = dict(token.split(' ', 1) for token in tokens[1:] if ' ' in token)
+            yield tokens[0], annotations.get('sm')
+
+
+def write_fens_parallel(stream, engine_path, ucioptions, variant, count, min_depth, max_depth, add_move, required_pieces, workers, fen_list=None, progress_callback: ProgressCallback = None, batch_size: int = 100, dedup_error_rate: float = 0, seen_limit: Optional[int] = None, move_source: str = 'engine',
+                        seed: int = 0, first_batch: int = 0, seen=None, checkpoint: Optional[Callable[[int, int], None]] = None):
+    """Generate count distinct positions with workers engine processes and write them to stream.
+
+    Batches are written in order, so the output only depends on seed, apart from engine
+    nondeterminism. After each batch is flushed, checkpoint is called with the number of
+    batches and positions written, and a later call can continue from first_batch with
+    the seen positions of the earlier output.
+
+    Positions already written are dropped. By default a compact exact set of position
+    hashes is kept, a positive dedup_error_rate uses a Bloom filter with bounded memory
+    instead, which wrongly drops about that fraction of the new positions. With seen_limit,
+    either set forgets all positions once it holds that many, to keep memory flat, so
+    positions from before can be written again.
+    """
+    if seen is None:
+        seen = seen_set(seen_limit, dedup_error_rate, count)
     written = 0
-    with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(total=count, desc="Generating positions") as pbar:
-        futures = []
-        # Submit initial batches
-        for _ in range(min(workers, total_batches)):
-            submit_count = min(batch_size, count - submitted * batch_size)
-            futures.append(executor.submit(
-                generate_fens_worker,
-                engine_path,
-                ucioptions,
-                variant,
-                min_depth,
-                max_depth,
-                add_move,
-                required_pieces,
-                submit_count,
-                fen_list
-            ))
-            submitted += 1
-        while futures:
-            for future in as_completed(futures):
-                results = future.result()
+    duplicates = 0
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(engine_path, ucioptions, variant, min_depth, max_depth, add_move, required_pieces, fen_list,
+                                             move_source, seed, batch_size))
+    with tqdm(total=count, desc="Generating positions") as pbar:
+        try:
+            batches = itertools.count(first_batch)
+            for batch, results in zip(batches, parallel.imap(executor, generate_batch, itertools.count(first_batch), 2 * workers)):
                 for fen, move in results:
+                    key = position_key(fen, move)
+                    if key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(key)
                     stream.write('{};variant {}'.format(fen, variant) + (';sm {}'.format(move) if move else '') + os.linesep)
                     written += 1
                     pbar.update(1)
                     if progress_callback:
                         progress_callback(written, count)
                     if written >= count:
-                        stream.flush()
-                        return
+                        break
                 stream.flush()  # Flush after each batch
-                futures.remove(future)
-                # Submit next batch if needed
-                if submitted < total_batches:
-                    submit_count = min(batch_size, count - submitted * batch_size)
-                    futures.append(executor.submit(
-                        generate_fens_worker,
-                        engine_path,
-                        ucioptions,
-                        variant,
-                        min_depth,
-                        max_depth,
-                        add_move,
-                        required_pieces,
-                        submit_count,
-                        fen_list
-                    ))
-                    submitted += 1
+                if checkpoint:
+                    checkpoint(batch + 1, written)
+                if written >= count:
+                    break
+        finally:
+            # keep the positions of completed batches if a worker dies
+            stream.flush()
+            executor.shutdown(cancel_futures=True)
+    if written + duplicates:
+        sys.stderr.write('Dropped {} duplicate positions ({:.1%} of generated)\n'.format(duplicates, duplicates / (written + duplicates)))
+    return written
+
+
+def manifest_path(output_path):
+    return output_path + '.manifest.json'
+
+
+def read_manifest(output_path):
+    try:
+        with open(manifest_path(output_path), encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(output_path, manifest):
+    # replace atomically so a crash never leaves a truncated manifest
+    path = manifest_path(output_path)
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
 
 
 def run_generator(
-    engine_path: str,
+    engine_path: Optional[str],
     variant: str,
     count: int,
     output_path: str,
@@ -123,9 +227,19 @@ def run_generator(
     workers: int = 1,
     fen_file: Optional[str] = None,
     skill_level: int = 10,
+    batch_size: int = 100,
+    dedup_error_rate: float = 0,
+    seen_limit: Optional[int] = None,
+    move_source: str = 'engine',
+    seed: Optional[int] = None,
+    resume: bool = False,
     progress_callback: ProgressCallback = None,
 ):
-    """Helper used by the GUI to generate FENs without spawning a subprocess."""
+    """Helper used by the GUI to generate FENs without spawning a subprocess.
+
+    Progress is recorded in a manifest next to the output. With resume, a partially
+    written output is continued from its last complete batch with the same seed.
+    """
 
     options = dict(ucioptions or {})
     options.setdefault('Skill Level', skill_level)
@@ -136,26 +250,56 @@ def run_generator(
         with open(fen_file, encoding='utf8') as f:
             fen_list = [line.split(';')[0].strip() for line in f if line.strip() and not line.startswith('#')]
 
-    with open(output_path, 'w', encoding='utf8') as stream:
-        write_fens_parallel(
-            stream,
-            engine_path,
-            options,
-            variant,
-            count,
-            min_depth,
-            max_depth,
-            add_move,
-            required_pieces,
-            workers,
-            fen_list,
-            progress_callback,
-        )
+    manifest = read_manifest(output_path) if resume else None
+    if manifest:
+        if seed is not None and seed != manifest['seed']:
+            raise ValueError('Seed {} differs from seed {} of the output to resume'.format(seed, manifest['seed']))
+        # drop lines of the batch that was being written when the run stopped
+        os.truncate(output_path, manifest['offset'])
+        seen = seen_set(seen_limit, dedup_error_rate, count)
+        for fen, move in read_positions(output_path):
+            seen.add(position_key(fen, move))
+    else:
+        manifest = {'seed': random.randrange(2 ** 32) if seed is None else seed, 'batches': 0, 'positions': 0, 'offset': 0}
+        seen = None
+        with open(output_path, 'w', encoding='utf8'):
+            pass
+    done = manifest['positions']
+
+    with open(output_path, 'a', encoding='utf8') as stream:
+        def checkpoint(batches, written):
+            manifest.update(batches=batches, positions=done + written, offset=stream.tell())
+            write_manifest(output_path, manifest)
+
+        write_manifest(output_path, manifest)
+        if count > done:
+            write_fens_parallel(
+                stream,
+                engine_path,
+                options,
+                variant,
+                count - done,
+                min_depth,
+                max_depth,
+                add_move,
+                required_pieces,
+                workers,
+                fen_list,
+                progress_callback,
+                batch_size,
+                dedup_error_rate,
+                seen_limit,
+                move_source,
+                manifest['seed'],
+                manifest['batches'],
+                seen,
+                checkpoint,
+            )
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-e', '--engine', required=True, help='chess variant engine path, e.g., to Fairy-Stockfish')
+    parser.add_argument('-e', '--engine', help='chess variant engine path, e.g., to Fairy-Stockfish')
     parser.add_argument('-o', '--ucioptions', type=lambda kv: kv.split("="), action='append', default=[],
                         help='UCI option as key=value pair. Repeat to add more options.')
     parser.add_argument('-v', '--variant', default='chess', help='variant to generate positions for')
@@ -167,7 +311,23 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--pieces', default=None, help='only return positions containing one of these piece chars (case insensitive)')
     parser.add_argument('-w', '--workers', type=int, default=1, help='number of parallel workers')
     parser.add_argument('-f', '--fenfile', default=None, help='Optional FEN/EPD file to use as starting positions')
+    parser.add_argument('-b', '--batch-size', type=int, default=100, help='number of positions workers return at once')
+    parser.add_argument('--dedup-error-rate', type=float, default=0,
+                        help='use a Bloom filter with this false positive rate to drop duplicates (default: exact set)')
+    parser.add_argument('--seen-limit', type=int, default=None,
+                        help='maximum number of written positions remembered to drop repeats across the whole run, '
+                             'not per worker; batches only drop repeats within themselves (default: unlimited)')
+    parser.add_argument('--move-source', choices=MOVE_SOURCES, default='engine',
+                        help='engine: search every ply, pv: play out the principal variation of each search, '
+                             'random: capture weighted random moves without engine (default: engine)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for reproducible runs (default: random)')
+    parser.add_argument('--output', default=None, help='output file, with a manifest to resume from (default: stdout)')
+    parser.add_argument('--resume', action='store_true', help='continue a partially written output file')
     args = parser.parse_args()
+    if not args.engine and args.move_source != 'random':
+        parser.error('an engine is required unless --move-source random is used')
+    if args.resume and not args.output:
+        parser.error('--resume requires --output')
 
     ucioptions = dict(args.ucioptions)
     ucioptions.update({'Skill Level': args.skill_level})
@@ -178,16 +338,42 @@ if __name__ == '__main__':
         with open(args.fenfile, encoding='utf8') as f:
             fen_list = [line.split(';')[0].strip() for line in f if line.strip() and not line.startswith('#')]
 
-    write_fens_parallel(
-        sys.stdout,
-        args.engine,
-        ucioptions,
-        args.variant,
-        args.count,
-        args.min_depth,
-        args.max_depth,
-        args.add_move,
-        args.pieces,
-        args.workers,
-        fen_list
-    )
+    if args.output:
+        run_generator(
+            args.engine,
+            args.variant,
+            args.count,
+            args.output,
+            ucioptions,
+            min_depth=args.min_depth,
+            max_depth=args.max_depth,
+            add_move=args.add_move,
+            required_pieces=args.pieces,
+            workers=args.workers,
+            fen_file=args.fenfile,
+            batch_size=args.batch_size,
+            dedup_error_rate=args.dedup_error_rate,
+            seen_limit=args.seen_limit,
+            move_source=args.move_source,
+            seed=args.seed,
+            resume=args.resume,
+        )
+    else:
+        write_fens_parallel(
+            sys.stdout,
+            args.engine,
+            ucioptions,
+            args.variant,
+            args.count,
+            args.min_depth,
+            args.max_depth,
+            args.add_move,
+            args.pieces,
+            args.workers,
+            fen_list,
+            batch_size=args.batch_size,
+            dedup_error_rate=args.dedup_error_rate,
+            seen_limit=args.seen_limit,
+            move_source=args.move_source,
+            seed=random.randrange(2 ** 32) if args.seed is None else args.seed,
+        )
@@ -1,14 +1,15 @@
 import argparse
 import fileinput
-import os
+from functools import lru_cache
+from io import StringIO
 import sys
-import tempfile
 
 import pyffish as sf
 import cshogi
 import cshogi.KIF
 
 
+@lru_cache(maxsize=None)
 def get_board_dimensions(variant):
     """Get board dimensions for a shogi variant."""
     try:
@@ -20,6 +21,20 @@ def get_board_dimensions(variant):
         return 9, 9  # Default to standard shogi
 
 
+@lru_cache(maxsize=None)
+def usi_square_table(variant):
+    """Mapping of pyffish squares to USI squares, built once per variant.
+
+    Tables are cached by variant name, so custom variants need to be loaded before the first conversion.
+    """
+    board_width, board_height = get_board_dimensions(variant)
+    # files a->board_width, b->board_width-1, ... and ranks 1->last rank letter, 2->second last, ...
+    table = {chr(ord('a') + f) + str(r + 1): str(board_width - f) + chr(ord('a') + board_height - 1 - r)
+             for f in range(board_width) for r in range(board_height)}
+    # only two character squares are converted
+    return {square: usi for square, usi in table.items() if len(square) == 2}
+
+
 def pyffish_to_usi_square(pyffish_square, variant):
     """Convert pyffish square notation to USI square notation.
     
@@ -28,32 +43,10 @@ def pyffish_to_usi_square(pyffish_square, variant):
     
     Board size is determined dynamically based on the variant.
     """
-    if len(pyffish_square) != 2:
-        return None
-        
-    pyffish_file = pyffish_square[0]  # a-...
-    pyffish_rank = pyffish_square[1]  # 1-...
-    
-    # Get board dimensions
-    board_width, board_height = get_board_dimensions(variant)
-    
-    # Create dynamic file mapping: a->board_width, b->board_width-1, ...
-    file_chars = [chr(ord('a') + i) for i in range(board_width)]
-    file_map = {file_chars[i]: str(board_width - i) for i in range(board_width)}
-    
-    # Create dynamic rank mapping: 1->last_rank_char, 2->second_last_rank_char, ...
-    rank_chars = [chr(ord('a') + i) for i in range(board_height)]
-    rank_digits = [str(i + 1) for i in range(board_height)]
-    rank_map = {rank_digits[i]: rank_chars[board_height - 1 - i] for i in range(board_height)}
-    
-    usi_file = file_map.get(pyffish_file)
-    usi_rank = rank_map.get(pyffish_rank)
-    
-    if usi_file and usi_rank:
-        return usi_file + usi_rank
-    return None
+    return usi_square_table(variant).get(pyffish_square)
 
 
+@lru_cache(maxsize=1 << 16)
 def pyffish_to_usi_move(pyffish_move, variant):
     """Convert pyffish UCI move to USI move."""
     if '@' in pyffish_move:
@@ -73,6 +66,19 @@ def pyffish_to_usi_move(pyffish_move, variant):
     return None
 
 
+class StreamExporter(cshogi.KIF.Exporter):
+    """KIF exporter writing to an open text stream instead of a file it opens itself."""
+
+    def __init__(self, stream):
+        self.kifu = stream
+        self.prev_move = None
+        self.move_number = 1
+
+    def close(self):
+        # the stream belongs to the caller
+        pass
+
+
 def is_shogi_variant(variant):
     """Check if variant is shogi-related."""
     shogi_variants = ['shogi', 'minishogi', 'kyotoshogi', 'euroshogi', 'torishogi', 'yarishogi', 'okisakishogi', 'shoshogi']
@@ -81,6 +87,7 @@ def is_shogi_variant(variant):
 
 def epd_to_kif(epd_stream, kif_stream):
     """Convert EPD puzzle format to KIF format."""
+    variants = set(sf.variants())
     for epd in epd_stream:
         tokens = epd.strip().split(';')
         if not tokens:
@@ -95,7 +102,7 @@ def epd_to_kif(epd_stream, kif_stream):
             print(f"Skipping non-shogi variant: {variant}", file=sys.stderr)
             continue
 
-        if variant not in sf.variants():
+        if variant not in variants:
             raise Exception("Unsupported variant: {}".format(variant))
 
         # Get the move sequence from pv annotation
@@ -122,71 +129,38 @@ def epd_to_kif(epd_stream, kif_stream):
                 continue
 
             # Convert pyffish FEN to cshogi SFEN format using pyffish
+            start_sfen = sf.get_fen(variant, fen, [], False, True, True)
             try:
-                start_sfen = sf.get_fen(variant, fen, [], False, True, True)
                 board = cshogi.Board(start_sfen)
-            except (ValueError, IndexError):
-                # If parsing fails, start with default position
-                board = cshogi.Board()
+            except (ValueError, IndexError) as e:
+                print(f"Invalid start position {start_sfen}: {e}", file=sys.stderr)
+                continue
+
+            # Render the KIF into a buffer, so that skipped puzzles leave no partial output
+            buffer = StringIO()
+            exporter = StreamExporter(buffer)
+            # Write KIF header with the starting position (BOD) before the moves are applied
+            exporter.header(['先手', '後手'], handicap=board)
 
-            # Apply the moves to build the game
-            valid_moves = []
+            # Apply and record the moves on the same board
+            valid_moves = 0
             for usi_move in usi_moves:
                 try:
+                    move = board.move_from_usi(usi_move)
                     board.push_usi(usi_move)
-                    valid_moves.append(usi_move)
                 except ValueError as e:
                     print(f"Invalid USI move {usi_move}: {e}", file=sys.stderr)
                     break
+                exporter.move(move, sec=0, sec_sum=0)
+                valid_moves += 1
 
             if not valid_moves:
                 print(f"No valid moves found, skipping puzzle", file=sys.stderr)
                 continue
 
-            # Export to KIF format using cshogi
-            try:
-                # Create a temporary file for the KIF exporter
-                with tempfile.NamedTemporaryFile(mode='w+', suffix='.kifu', delete=False, encoding='utf8') as temp_file:
-                    temp_path = temp_file.name
-                
-                try:
-                    # Create KIF exporter with temporary file path
-                    exporter = cshogi.KIF.Exporter(path=temp_path)
-                    
-                    # Write KIF header with handicap (SFEN) for custom starting position
-                    exporter.header(['先手', '後手'], handicap=f"sfen {start_sfen}")
-
-                    # Write moves to KIF
-                    board = cshogi.Board(start_sfen)
-                    for i, usi_move in enumerate(valid_moves, 1):
-                        try:
-                            move_obj = board.move_from_usi(usi_move)
-                            exporter.move(move_obj, sec=0, sec_sum=0)
-                            board.push_usi(usi_move)
-                        except Exception as move_error:
-                            print(f"Error processing move {usi_move}: {move_error}", file=sys.stderr)
-
-                    # End the game
-                    exporter.end('resign', sec=0, sec_sum=0)
-                    exporter.close()
-                    
-                    # Read the temporary file content and write to stream
-                    with open(temp_path, 'r', encoding='utf-8') as kif_file:
-                        kif_content = kif_file.read()
-                        
-                        if kif_content:
-                            kif_stream.write(kif_content)
-                            if not kif_content.endswith('\n'):
-                                kif_stream.write('\n')
-                        else:
-                            print(f"Warning: KIF exporter returned empty content", file=sys.stderr)
-                finally:
-                    # Clean up temporary file
-                    if os.path.exists(temp_path):
-                        os.unlink(temp_path)
-                    
-            except Exception as export_error:
-                print(f"Error writing KIF: {export_error}", file=sys.stderr)
+            # End the game
+            exporter.end('resign', sec=0, sec_sum=0)
+            kif_stream.write(buffer.getvalue())
 
         except Exception as e:
             print(f"Error processing puzzle: {e}", file=sys.stderr)
@@ -0,0 +1,25 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import islice
+
+
+def imap(executor, fn, iterable, window, ordered=True):
+    """Lazily map fn over iterable on executor with at most window tasks in flight.
+
+    Results are yielded in input order, or in completion order if ordered is False.
+    Input is only consumed as tasks finish, so arbitrarily long streams can be mapped.
+    """
+    items = iter(iterable)
+    pending = deque(executor.submit(fn, item) for item in islice(items, window))
+    while pending:
+        if ordered:
+            done = [pending.popleft()]
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+        for future in done:
+            # keep the workers busy before handing the result to the consumer
+            for item in islice(items, 1):
+                pending.append(executor.submit(fn, item))
+            yield future.result()
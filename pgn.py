@@ -1,10 +1,14 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import fileinput
+from itertools import islice
 import os
 import sys
 
 import pyffish as sf
 
+import parallel
+
 
 PGN_HEADER = """
 [Event "{}"]
@@ -16,35 +20,75 @@ PGN_HEADER = """
 """
 
 
+def movetext(fen, san_moves):
+    """Numbered movetext, counting moves from the fullmove number and side to move of fen.
+
+    EPD FENs without move counters start at move 1 like in pyffish.
+    """
+    fields = fen.split(' ')
+    fullmove = int(fields[-1]) if fields[-1].isdigit() else 1
+    white_to_move = fields[1] == 'w'
+    tokens = []
+    for i, san_move in enumerate(san_moves):
+        if white_to_move:
+            tokens.append('{}. {}'.format(fullmove, san_move))
+        else:
+            tokens.append('{}... {}'.format(fullmove, san_move) if i == 0 else san_move)
+            fullmove += 1
+        white_to_move = not white_to_move
+    return ''.join(token + ' ' for token in tokens)
+
+
+def game_pgn(epd, variants):
+    """PGN of a single EPD line, for variants being the set of supported variants."""
+    tokens = epd.strip().split(';')
+    fen = tokens[0]
+    annotations = dict(token.split(' ', 1) for token in tokens[1:])
+    variant = annotations['variant']
+
+    if variant not in variants:
+        raise Exception("Unsupported variant: {}".format(variant))
+
+    site = annotations.get('site', 'https://github.com/ianfab/Fairy-Stockfish')
+    moves = annotations.get('pv', '').split(',')
+    san_moves = sf.get_san_moves(variant, fen, moves)
+    return '{}{}*{}'.format(PGN_HEADER.format(annotations.get('type'), site, variant.capitalize(), fen),
+                            movetext(fen, san_moves), os.linesep)
+
+
 def epd_to_pgn(epd_stream, pgn_stream):
+    variants = set(sf.variants())
     for epd in epd_stream:
-        tokens = epd.strip().split(';')
-        fen = tokens[0]
-        annotations = dict(token.split(' ', 1) for token in tokens[1:])
-        variant = annotations['variant']
-
-        if variant not in sf.variants():
-            raise Exception("Unsupported variant: {}".format(variant))
-
-        site = annotations.get('site', 'https://github.com/ianfab/Fairy-Stockfish')
-        pgn_stream.write(PGN_HEADER.format(annotations.get('type'), site, variant.capitalize(), fen))
-        moves = annotations.get('pv', '').split(',')
-        san_moves = sf.get_san_moves(variant, fen, moves)
-        for i, san_move in enumerate(san_moves):
-            cur_fen = sf.get_fen(variant, fen, moves[:i])
-            fullmove = cur_fen.split(' ')[-1]
-            whiteToMove = cur_fen.split(' ')[1] == 'w'
-            movenum = '{}. '.format(fullmove) if whiteToMove else '{}... '.format(fullmove) if i == 0 else ''
-            pgn_stream.write('{}{} '.format(movenum, san_move))
-        pgn_stream.write('*{}'.format(os.linesep))
+        pgn_stream.write(game_pgn(epd, variants))
+
+
+def _init_worker(variant_path):
+    sf.set_option("VariantPath", variant_path)
+
+
+def _chunk_to_pgn(epds):
+    return ''.join(game_pgn(epd, set(sf.variants())) for epd in epds)
+
+
+def epd_to_pgn_parallel(epd_stream, pgn_stream, workers, variant_path='', chunk_size=1000):
+    """Like epd_to_pgn, but converts chunks of chunk_size lines in workers processes."""
+    chunks = iter(lambda: list(islice(epd_stream, chunk_size)), [])
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(variant_path,)) as executor:
+        for pgn in parallel.imap(executor, _chunk_to_pgn, chunks, 2 * workers):
+            pgn_stream.write(pgn)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('epd_files', nargs='*', help='EPD input files generated by puzzler.py')
     parser.add_argument('-p', '--variant-path', default='', help='custom variants definition file path')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes converting chunks of the input')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of lines per chunk for --workers')
     args = parser.parse_args()
 
     sf.set_option("VariantPath", args.variant_path)
     with fileinput.input(args.epd_files, encoding='utf8') as instream:
-        epd_to_pgn(instream, sys.stdout)
+        if args.workers > 1:
+            epd_to_pgn_parallel(instream, sys.stdout, args.workers, args.variant_path, args.chunk_size)
+        else:
+            epd_to_pgn(instream, sys.stdout)
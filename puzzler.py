@@ -1,9 +1,13 @@
 import argparse
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 import fileinput
 from functools import partial
+import json
 import math
+import os
 import sys
-import threading
 import time
 from typing import Callable, Dict, Optional
 
@@ -11,11 +15,16 @@ from tqdm import tqdm
 import pyffish as sf
 import numpy as np
 
+from analysis_cache import AnalysisCache, engine_fingerprint
+import parallel
 import uci
 
 
 ProgressCallback = Optional[Callable[[int, Optional[int]], None]]
 
+# when to send ucinewgame and thereby clear the engine hash
+CLEAR_HASH_POLICIES = ('puzzle', 'file', 'never')
+
 
 def line_count(filename):
     f = open(filename, 'rb')
@@ -84,35 +93,78 @@ def get_puzzle_theme(multipv_info, win_threshold, unclear_threshold, mate_distan
 
     return None
 
-def timeout_monitor(engine: uci.Engine, timeout, count_time: threading.Event):
-    while True:
-        count_time.wait()
-        start_time = time.time()
-        lock = threading.Lock()
-        while time.time() < start_time + timeout:
-            if not count_time.is_set():
-                break
-        else:
-            with lock:
-                engine.write('stop\n')
-                count_time.clear()
-        
-
-def get_puzzle(variant, fen, moves, engine, depth, win_threshold, unclear_threshold, mate_distance_ratio, count_time: threading.Event):
+def puzzle_gap(multipv_info, win_threshold, unclear_threshold):
+    """Ratio of the value gap between the two best moves to the minimum gap of a puzzle."""
+    scale = win_threshold * 0.7
+    min_diff = sigmoid(win_threshold / scale) - sigmoid(unclear_threshold / scale)
+    if min_diff <= 0:
+        return math.inf
+    return (value(multipv_info[0], scale) - value(multipv_info[1], scale)) / min_diff
+
+
+def is_clearly_no_puzzle(info, prune_depth, prune_margin, win_threshold, unclear_threshold):
+    """Early exit check for searches: True if the position is far from being a puzzle at prune_depth or deeper."""
+    multipv_info = info[-1]
+    return (len(multipv_info) >= 2 and multipv_info[0]['depth'] >= prune_depth and not is_mate(multipv_info[0])
+            and puzzle_gap(multipv_info, win_threshold, unclear_threshold) < prune_margin)
+
+
+def is_pruned(info, depth, stop_when):
+    """Whether a search was stopped by stop_when before it reached depth."""
+    return bool(stop_when and info and info[-1][0]['depth'] < depth)
+
+
+def search_position(variant, fen, moves, engine, depth, deadline: Optional[float] = None, cache: Optional[AnalysisCache] = None, stop_when=None):
+    multipv = int(engine.options.get('multipv', 1))
+    info = cache.get(variant, fen, moves, depth, multipv) if cache else None
+    if info is None:
+        if engine.options.get('UCI_Variant') != variant:
+            engine.setoption('UCI_Variant', variant)
+            engine.newgame()
+        engine.position(fen, moves)
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            raise TimeoutError
+        _, info, timed_out = engine.search(timeout, stop_when, depth=depth)
+        if timed_out:
+            raise TimeoutError
+        # pruned searches did not reach the requested depth
+        if cache and not is_pruned(info, depth, stop_when):
+            cache.put(variant, fen, moves, depth, multipv, info)
+    return info
+
+
+def get_puzzle(variant, fen, moves, engine, depth, win_threshold, unclear_threshold, mate_distance_ratio, deadline: Optional[float] = None, cache: Optional[AnalysisCache] = None, nodes: Optional[dict] = None, stop_when=None):
+    if len(sf.legal_moves(variant, fen, moves)) <= 2:
+        return None, None
+    info = search_position(variant, fen, moves, engine, depth, deadline, cache, stop_when)
+    # like unreached nodes, pruned ones count as no puzzle when rescoring
+    if nodes is not None and not is_pruned(info, depth, stop_when):
+        nodes[' '.join(moves)] = compact_info(info)
+    if not info or not isinstance(info[-1], list) or len(info[-1]) < 2:
+        sys.stderr.write(f"Warning: No valid multipv info for {fen} after {depth} depth search.\n")
+        sys.stderr.write(f"{info}\n")
+        return None, info
+    theme = get_puzzle_theme(info[-1], win_threshold, unclear_threshold, mate_distance_ratio)
+    return theme, info
+
+
+def replay_puzzle(variant, fen, moves, nodes, win_threshold, unclear_threshold, mate_distance_ratio):
+    """Like get_puzzle, but takes the analysis from nodes recorded by an earlier run."""
     if len(sf.legal_moves(variant, fen, moves)) <= 2:
         return None, None
-    engine.setoption('UCI_Variant', variant)
-    engine.newgame()
-    engine.position(fen, moves)
-    _, info = engine.go(depth=depth)
-    if count_time.is_set():
-        if not info or not isinstance(info[-1], list) or len(info[-1]) < 2:
-            sys.stderr.write(f"Warning: No valid multipv info for {fen} after {depth} depth search.\n")
-            sys.stderr.write(f"{info}\n")
-            return None, info
-        theme = get_puzzle_theme(info[-1], win_threshold, unclear_threshold, mate_distance_ratio)
-        return theme, info
-    raise TimeoutError
+    # nodes the original run did not reach count as no puzzle
+    info = nodes.get(' '.join(moves))
+    if not info or not isinstance(info[-1], list) or len(info[-1]) < 2:
+        return None, info
+    theme = get_puzzle_theme(info[-1], win_threshold, unclear_threshold, mate_distance_ratio)
+    return theme, info
+
+
+def compact_info(info):
+    """Strip search info down to the fields needed to rate puzzles."""
+    return [[{k: v for k, v in info_line.items() if k in ('depth', 'multipv', 'score', 'pv')} for info_line in multipv_info]
+            for multipv_info in info]
 
 
 def rate_puzzle(info, win_threshold):
@@ -162,111 +214,369 @@ def _infer_filename(instream):
     return filename
 
 
-def generate_puzzles(instream, outstream, engine, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, timeout, progress_callback: ProgressCallback = None, use_tqdm: bool = True):
-    if failed_file:
-        ff = open(failed_file, "w", encoding='utf8')
+def parse_epd(epd, variant):
+    """Return the FEN, annotations, variant and the moves leading to the puzzle position of an EPD line."""
+    tokens = epd.strip().split(';')
+    fen = tokens[0]
+    annotations = dict(token.split(' ', 1) for token in tokens[1:])
+    current_variant = annotations.get('variant', variant)
+    if not current_variant:
+        raise Exception('Variant neither provided in EPD nor as argument')
+    pv = []
+    if 'sm' in annotations and annotations['sm'] in sf.legal_moves(current_variant, fen, []):
+        pv.append(annotations['sm'])
+    return fen, annotations, current_variant, pv
+
+
+def find_puzzle(epd, variant, win_threshold, mate_distance_ratio, clean_distance, mate_only, get_node_puzzle):
+    """Extend the puzzle line of an EPD as long as its positions remain puzzles.
+
+    get_node_puzzle(variant, fen, moves, mate_distance_ratio) returns the puzzle theme
+    and the multipv info of a single position.
+    Returns the annotated puzzle EPD line, or None if the position yields no puzzle.
+    """
+    fen, annotations, current_variant, pv = parse_epd(epd, variant)
+    stm_index = len(pv)
+    evals = []
+    qualities = []
+    volatilities = []
+    volatilities2 = []
+    accuracies = []
+    accuracies2 = []
+    mate_distance_fractions = []
+    types = []
 
-    filename = _infer_filename(instream)
+    while True:
+        # only apply mate distance ratio once clean distance is reached
+        effective_mate_distance_ratio = mate_distance_ratio if (len(pv) - stm_index) / 2 >= clean_distance else 0
+        puzzle_type, info = get_node_puzzle(current_variant, fen, pv, effective_mate_distance_ratio)
+        if not puzzle_type or (mate_only and puzzle_type != 'mate'):
+            # trim last opponent move
+            if pv:
+                pv.pop()
+            # re-tag incomplete mates
+            if types and types[0] == 'mate':
+                types[0] = 'partial-mate'
+            break
+        evals.append(info[-1][0])
+        volatility, volatility2, accuracy, accuracy2, quality, mate_distance_fraction = rate_puzzle(info, win_threshold)
+        qualities.append(quality)
+        volatilities.append(volatility)
+        volatilities2.append(volatility2)
+        accuracies.append(accuracy)
+        accuracies2.append(accuracy2)
+        mate_distance_fractions.append(mate_distance_fraction)
+        types.append(puzzle_type)
+        pv += info[-1][0]['pv'][:2]
+        if len(info[-1][0]['pv']) < 2:
+            break
+
+    if len(pv) > stm_index and (not mate_only or (len(types) > 0 and types[0] == 'mate')):
+        std = np.std([value(e, win_threshold) for e in evals])
+        difficulty = 4 * volatilities[0] + 2 * std + accuracies[0]
+        content = len(pv) - stm_index - 40 * volatilities2[0]
+        total_quality = sum(qualities) / len(qualities)
+        # output
+        annotations['variant'] = current_variant
+        if stm_index == 1:
+            annotations['sm'] = pv[0]
+        annotations['bm'] = pv[stm_index]
+        annotations['eval'] = format_eval(evals[0])
+        annotations['difficulty'] = '{:.3f}'.format(difficulty)
+        annotations['content'] = '{:.3f}'.format(content)
+        annotations['quality'] = '{:.3f}'.format(total_quality)
+        annotations['volatility'] = '{:.3f}'.format(volatilities[0])
+        annotations['volatility2'] = '{:.3f}'.format(volatilities2[0])
+        annotations['accuracy'] = '{:.3f}'.format(accuracies[0])
+        annotations['accuracy2'] = '{:.3f}'.format(accuracies2[0])
+        annotations['std'] = '{:.3f}'.format(std)
+        annotations['ambiguity'] = '{:.3f}'.format(max(mate_distance_fractions))
+        annotations['type'] = types[0]
+        annotations['pv'] = ','.join(pv)
+        ops = ';'.join('{} {}'.format(k, v) for k, v in annotations.items())
+        return '{};{}\n'.format(fen, ops)
+    return None
 
-    # When reading from sys.stdin, filename() is "-"
-    total = None if (not filename or filename == "-") else line_count(filename)
-
-    iterator = tqdm(instream, total=total) if use_tqdm else instream
-
-    count_time = threading.Event()
-    monitor_thread = threading.Thread(target=timeout_monitor, daemon=True, args=[engine, timeout, count_time])
-    monitor_thread.start()
-
-    for i, epd in enumerate(iterator):
-        tokens = epd.strip().split(';')
-        fen = tokens[0]
-        annotations = dict(token.split(' ', 1) for token in tokens[1:])
-        current_variant = annotations.get('variant', variant)
-        if not current_variant:
-            raise Exception('Variant neither provided in EPD nor as argument')
-        pv = []
-        if 'sm' in annotations and annotations['sm'] in sf.legal_moves(current_variant, fen, []):
-            pv.append(annotations['sm'])
-        stm_index = len(pv)
-        evals = []
-        qualities = []
-        volatilities = []
-        volatilities2 = []
-        accuracies = []
-        accuracies2 = []
-        mate_distance_fractions = []
-        types = []
-        
-        is_timed_out = False	
-        count_time.set()
-        while True:	
-            try:
-                # only apply mate distance ratio once clean distance is reached
-                effective_mate_distance_ratio = mate_distance_ratio if (len(pv) - stm_index) / 2 >= clean_distance else 0
-                puzzle_type, info = get_puzzle(current_variant, fen, pv, engine, depth, win_threshold, unclear_threshold, effective_mate_distance_ratio, count_time)
-            except TimeoutError:
-                is_timed_out = True
-                break
-            if not puzzle_type or (mate_only and puzzle_type != 'mate'):
-                # trim last opponent move
-                if pv:
-                    pv.pop()
-                # re-tag incomplete mates
-                if types and types[0] == 'mate':
-                    types[0] = 'partial-mate'
-                break
-            evals.append(info[-1][0])
-            volatility, volatility2, accuracy, accuracy2, quality, mate_distance_fraction = rate_puzzle(info, win_threshold)
-            qualities.append(quality)
-            volatilities.append(volatility)
-            volatilities2.append(volatility2)
-            accuracies.append(accuracy)
-            accuracies2.append(accuracy2)
-            mate_distance_fractions.append(mate_distance_fraction)
-            types.append(puzzle_type)
-            pv += info[-1][0]['pv'][:2]
-            if len(info[-1][0]['pv']) < 2:
-                break
-
-        count_time.clear()
-        if is_timed_out:
+
+class TriageRejected(Exception):
+    """Raised when a shallow triage search shows that a position is clearly no puzzle."""
+
+    def __init__(self, depth):
+        super().__init__('rejected by triage search at depth {}'.format(depth))
+        self.depth = depth
+
+
+def analyse_epd(epd, engine, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, deadline: Optional[float] = None, cache: Optional[AnalysisCache] = None, nodes: Optional[dict] = None, clear_hash: str = 'puzzle', stop_when=None, triage_depths=(), triage_margin: float = 0.5):
+    """Search a single EPD line for a puzzle using the engine.
+
+    If nodes is given, the analysis of every searched position is recorded in it.
+    stop_when is passed on to uci.Engine.go to end searches of hopeless positions early.
+    Before the full depth search, the puzzle position is searched at each of the triage_depths
+    and TriageRejected is raised if it is clearly no puzzle (see is_clearly_no_puzzle).
+    Raises TimeoutError if the analysis is not finished by the deadline (in time.monotonic() seconds).
+    """
+    if clear_hash == 'puzzle':
+        engine.newgame()
+
+    if triage_depths:
+        fen, _, current_variant, moves = parse_epd(epd, variant)
+        if len(sf.legal_moves(current_variant, fen, moves)) > 2:
+            for triage_depth in triage_depths:
+                info = search_position(current_variant, fen, moves, engine, triage_depth, deadline, cache)
+                if info and is_clearly_no_puzzle(info, 0, triage_margin, win_threshold, unclear_threshold):
+                    raise TriageRejected(triage_depth)
+
+    def get_node_puzzle(current_variant, fen, moves, effective_mate_distance_ratio):
+        return get_puzzle(current_variant, fen, moves, engine, depth, win_threshold, unclear_threshold, effective_mate_distance_ratio, deadline, cache, nodes, stop_when)
+    return find_puzzle(epd, variant, win_threshold, mate_distance_ratio, clean_distance, mate_only, get_node_puzzle)
+
+
+def rescore_epd(record, variant, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only):
+    """Recompute the puzzle of an EPD line from analysis recorded with --dump-infos."""
+    def get_node_puzzle(current_variant, fen, moves, effective_mate_distance_ratio):
+        return replay_puzzle(current_variant, fen, moves, record['nodes'], win_threshold, unclear_threshold, effective_mate_distance_ratio)
+    return find_puzzle(record['epd'], variant, win_threshold, mate_distance_ratio, clean_distance, mate_only, get_node_puzzle)
+
+
+LineResult = namedtuple('LineResult', ['epd', 'puzzle', 'timed_out', 'nodes', 'rejected_depth', 'index'], defaults=(None,))
+
+
+def _analyse_line(epd, engine, timeout, dump, args, kwargs):
+    nodes = {} if dump else None
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        return LineResult(epd, analyse_epd(epd, engine, *args, deadline=deadline, nodes=nodes, **kwargs), False, nodes, None)
+    except TimeoutError:
+        return LineResult(epd, None, True, None, None)
+    except TriageRejected as e:
+        return LineResult(epd, None, False, nodes, e.depth)
+
+
+def input_lines(instream, done=()):
+    """(index, line, file) triples of the input lines not in done, with file counting the input files.
+
+    Files are told apart for fileinput streams, other streams count as a single file.
+    """
+    file = 0
+    for index, line in enumerate(instream):
+        if index and isinstance(instream, fileinput.FileInput) and instream.isfirstline():
+            file += 1
+        if index not in done:
+            yield index, line, file
+
+
+def _analyse_lines(lines, engine, timeout, dump, args, kwargs):
+    """Analyse (index, EPD, file) lines one by one, yielding a LineResult for each."""
+    current_file = None
+    for index, epd, file in lines:
+        if kwargs.get('clear_hash') == 'file' and file != current_file:
+            engine.newgame()
+            current_file = file
+        yield _analyse_line(epd, engine, timeout, dump, args, kwargs)._replace(index=index)
+
+
+_worker = {}
+
+
+def _init_worker(engine_path, ucioptions, multipv, timeout, dump, cache_path, cache_size, kwargs):
+    engine = uci.Engine([engine_path], ucioptions)
+    engine.setoption('multipv', multipv)
+    sf.set_option("VariantPath", engine.options.get("VariantPath", ""))
+    kwargs = dict(kwargs, cache=AnalysisCache(cache_path, cache_size, engine_fingerprint(engine_path, ucioptions)) if cache_path else None)
+    _worker.update(engine=engine, timeout=timeout, dump=dump, kwargs=kwargs, file=None)
+
+
+def _analyse_worker(args, line):
+    index, epd, file = line
+    # each worker engine starts every input file with a cleared hash
+    if _worker['kwargs'].get('clear_hash') == 'file' and file != _worker['file']:
+        _worker['engine'].newgame()
+        _worker['file'] = file
+    return _analyse_line(epd, _worker['engine'], _worker['timeout'], _worker['dump'], args, _worker['kwargs'])._replace(index=index)
+
+
+def split_engine_options(options, workers):
+    """Divide the Threads and Hash budget given in options evenly among workers engines."""
+    options = dict(options)
+    for name in ('Threads', 'Hash'):
+        if name in options:
+            options[name] = max(1, int(options[name]) // workers)
+    return options
+
+
+class Journal():
+    """Record of the processed input lines of a run writing to a file, to resume it later.
+
+    Each line holds the index of an input line, followed by the sizes of the output,
+    failed and dump files after its results were written.
+    """
+
+    def __init__(self, path, resume=False):
+        self.done = set()
+        self.offsets = None
+        if resume and os.path.exists(path):
+            size = 0
+            with open(path, encoding='utf8') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        index, *self.offsets = map(int, line.split())
+                        self.done.add(index)
+                        size += len(line)
+            # drop a last line cut off by a crash
+            os.truncate(path, size)
+        self.resumed = bool(self.done)
+        self.file = open(path, 'a' if resume else 'w', encoding='utf8')
+
+    @classmethod
+    def for_output(cls, output_path, failed_file=None, dump_file=None, resume=False, path=None):
+        """Journal of output_path, with the outputs cut back to the last recorded line on resume.
+
+        Without a journaled line to resume from, the outputs are emptied, as all input is processed again.
+        """
+        journal = cls(path or output_path + '.journal', resume)
+        if resume:
+            for output, offset in zip((output_path, failed_file, dump_file), journal.offsets or (0, 0, 0)):
+                if output and os.path.exists(output):
+                    os.truncate(output, offset)
+        return journal
+
+    def pending(self, instream):
+        """(index, line) pairs of the input lines not processed yet."""
+        return ((index, line) for index, line, _ in input_lines(instream, self.done))
+
+    def record(self, index, *streams):
+        self.file.write(' '.join(str(offset) for offset in [index] + [stream.tell() if stream else 0 for stream in streams]) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def _write_results(results, outstream, failed_file, total, progress_callback, use_tqdm, dump_file=None, journal=None):
+    # continue the outputs of a resumed run
+    mode = 'a' if journal and journal.resumed else 'w'
+    ff = df = None
+    if failed_file:
+        ff = open(failed_file, mode, encoding='utf8')
+    if dump_file:
+        df = open(dump_file, mode, encoding='utf8')
+    if journal and total is not None:
+        total -= len(journal.done)
+
+    if use_tqdm:
+        results = tqdm(results, total=total)
+
+    stats = Counter()
+    for i, result in enumerate(results):
+        if result.timed_out:
+            stats['timeouts'] += 1
+            if journal:
+                journal.record(result.index, outstream, ff, df)
             continue
 
-        if len(pv) > stm_index and (not mate_only or (len(types) > 0 and types[0] == 'mate')):
-            std = np.std([value(e, win_threshold) for e in evals])
-            difficulty = 4 * volatilities[0] + 2 * std + accuracies[0]
-            content = len(pv) - stm_index - 40 * volatilities2[0]
-            total_quality = sum(qualities) / len(qualities)
-            # output
-            annotations['variant'] = current_variant
-            if stm_index == 1:
-                annotations['sm'] = pv[0]
-            annotations['bm'] = pv[stm_index]
-            annotations['eval'] = format_eval(evals[0])
-            annotations['difficulty'] = '{:.3f}'.format(difficulty)
-            annotations['content'] = '{:.3f}'.format(content)
-            annotations['quality'] = '{:.3f}'.format(total_quality)
-            annotations['volatility'] = '{:.3f}'.format(volatilities[0])
-            annotations['volatility2'] = '{:.3f}'.format(volatilities2[0])
-            annotations['accuracy'] = '{:.3f}'.format(accuracies[0])
-            annotations['accuracy2'] = '{:.3f}'.format(accuracies2[0])
-            annotations['std'] = '{:.3f}'.format(std)
-            annotations['ambiguity'] = '{:.3f}'.format(max(mate_distance_fractions))
-            annotations['type'] = types[0]
-            annotations['pv'] = ','.join(pv)
-            ops = ';'.join('{} {}'.format(k, v) for k, v in annotations.items())
-            outstream.write('{};{}\n'.format(fen, ops))
+        stats['analysed'] += 1
+        if result.rejected_depth:
+            stats['rejected', result.rejected_depth] += 1
+        if dump_file:
+            df.write(json.dumps({'epd': result.epd, 'nodes': result.nodes}, separators=(',', ':')) + '\n')
+
+        if result.puzzle:
+            stats['puzzles'] += 1
+            outstream.write(result.puzzle)
         elif failed_file:
-            ff.write(epd)
+            ff.write(result.epd)
+        if journal:
+            journal.record(result.index, outstream, ff, df)
 
         if i % 100 == 0:
-            outstream.flush()
+            _flush(outstream, ff, df, journal)
 
         if progress_callback:
             progress_callback(i + 1, total)
 
+    _flush(outstream, ff, df, journal)
     if failed_file:
         ff.close()
+    if dump_file:
+        df.close()
+    return stats
+
+
+def _flush(outstream, ff, df, journal):
+    # outputs first, so the journal never points past their end
+    for stream in (outstream, ff, df, journal):
+        if stream:
+            stream.flush()
+
+
+def report_triage(stats, triage_depths, depth):
+    """Write the number of positions entering and rejected at each search stage to stderr."""
+    remaining = stats['analysed']
+    for triage_depth in triage_depths:
+        rejected = stats['rejected', triage_depth]
+        sys.stderr.write('triage depth {}: {} positions, {} rejected ({:.1%})\n'.format(
+            triage_depth, remaining, rejected, rejected / remaining if remaining else 0))
+        remaining -= rejected
+    sys.stderr.write('full depth {}: {} positions, {} puzzles\n'.format(depth, remaining, stats['puzzles']))
+
+
+def _input_total(instream):
+    filename = _infer_filename(instream)
+    # When reading from sys.stdin, filename() is "-"
+    return None if (not filename or filename == "-") else line_count(filename)
+
+
+def _pruning(prune_depth, prune_margin, win_threshold, unclear_threshold):
+    if not prune_depth:
+        return None
+    return partial(is_clearly_no_puzzle, prune_depth=prune_depth, prune_margin=prune_margin,
+                   win_threshold=win_threshold, unclear_threshold=unclear_threshold)
+
+
+def generate_puzzles(instream, outstream, engine, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, timeout, progress_callback: ProgressCallback = None, use_tqdm: bool = True, cache: Optional[AnalysisCache] = None, dump_file: Optional[str] = None, clear_hash: str = 'puzzle', prune_depth: int = 0, prune_margin: float = 0.5, triage_depths=(), triage_margin: float = 0.5, journal: Optional[Journal] = None):
+    """Search the EPD lines of instream for puzzles and write them to outstream.
+
+    With a journal, lines it records as done are skipped and processed lines are added to it.
+    Returns a Counter of analysed, timed out and triage rejected positions and found puzzles.
+    """
+    total = _input_total(instream)
+    args = (variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only)
+    kwargs = dict(cache=cache, clear_hash=clear_hash, stop_when=_pruning(prune_depth, prune_margin, win_threshold, unclear_threshold),
+                  triage_depths=sorted(triage_depths), triage_margin=triage_margin)
+    lines = input_lines(instream, journal.done if journal else ())
+    results = _analyse_lines(lines, engine, timeout, bool(dump_file), args, kwargs)
+    return _write_results(results, outstream, failed_file, total, progress_callback, use_tqdm, dump_file, journal)
+
+
+def generate_puzzles_parallel(instream, outstream, engine_path, ucioptions, multipv, workers, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, timeout, progress_callback: ProgressCallback = None, use_tqdm: bool = True, ordered: bool = True, cache_path: Optional[str] = None, cache_size: int = 1000000, dump_file: Optional[str] = None, clear_hash: str = 'puzzle', prune_depth: int = 0, prune_margin: float = 0.5, triage_depths=(), triage_margin: float = 0.5, journal: Optional[Journal] = None):
+    """Like generate_puzzles, but distributes the input lines over workers engine processes.
+
+    Puzzles are written in input order, or as soon as they are found if ordered is False.
+    """
+    total = _input_total(instream)
+    args = (variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only)
+    kwargs = dict(clear_hash=clear_hash, stop_when=_pruning(prune_depth, prune_margin, win_threshold, unclear_threshold),
+                  triage_depths=sorted(triage_depths), triage_margin=triage_margin)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(engine_path, ucioptions, multipv, timeout, bool(dump_file), cache_path, cache_size, kwargs)) as executor:
+            lines = input_lines(instream, journal.done if journal else ())
+            results = parallel.imap(executor, partial(_analyse_worker, args), lines, 4 * workers, ordered)
+            return _write_results(results, outstream, failed_file, total, progress_callback, use_tqdm, dump_file, journal)
+    finally:
+        # workers only evict every 1000 entries they store, so bound the cache size once all are done
+        if cache_path:
+            AnalysisCache(cache_path, cache_size, engine_fingerprint(engine_path, ucioptions)).close()
+
+
+def rescore_puzzles(instream, outstream, variant, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, progress_callback: ProgressCallback = None, use_tqdm: bool = True):
+    """Like generate_puzzles, but replays the analysis recorded with --dump-infos instead of using an engine."""
+    total = _input_total(instream)
+    results = (LineResult(record['epd'], rescore_epd(record, variant, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only), False, None, None)
+               for record in map(json.loads, instream))
+    return _write_results(results, outstream, failed_file, total, progress_callback, use_tqdm)
 
 
 def run_puzzler(
@@ -285,38 +595,104 @@ def run_puzzler(
     mate_only: bool = False,
     failed_file: Optional[str] = None,
     timeout: int = 600,
+    workers: int = 1,
+    ordered: bool = True,
+    split_options: bool = False,
+    cache_path: Optional[str] = None,
+    cache_size: int = 1000000,
+    dump_file: Optional[str] = None,
+    clear_hash: str = 'puzzle',
+    prune_depth: int = 0,
+    prune_margin: float = 0.5,
+    triage_depths=(),
+    triage_margin: float = 0.5,
+    resume: bool = False,
+    journal_path: Optional[str] = None,
     progress_callback: ProgressCallback = None,
 ):
-    """Run puzzle extraction from Python without spawning a subprocess."""
+    """Run puzzle extraction from Python without spawning a subprocess.
 
-    options = dict(ucioptions or {})
-    engine = uci.Engine([engine_path], options)
-    engine.setoption('multipv', multipv)
-    sf.set_option("VariantPath", engine.options.get("VariantPath", ""))
+    With resume or a journal_path, processed input lines are journaled, by default next
+    to the output. With resume, lines of an interrupted run that were already processed
+    are skipped.
+    """
 
-    with open(input_path, encoding='utf8') as instream, open(output_path, 'a', encoding='utf8') as outstream:
-        generate_puzzles(
-            instream,
-            outstream,
-            engine,
-            variant,
-            depth,
-            win_threshold,
-            unclear_threshold,
-            mate_distance_ratio,
-            clean_distance,
-            mate_only,
-            failed_file,
-            timeout,
-            progress_callback,
-            use_tqdm=False,
-        )
+    options = dict(ucioptions or {})
+    if split_options:
+        options = split_engine_options(options, workers)
+
+    journal = Journal.for_output(output_path, failed_file, dump_file, resume, journal_path) if resume or journal_path else None
+    with open(input_path, encoding='utf8') as instream, open(output_path, 'a', encoding='utf8') as outstream, (journal.file if journal else nullcontext()):
+        if workers > 1:
+            return generate_puzzles_parallel(
+                instream,
+                outstream,
+                engine_path,
+                options,
+                multipv,
+                workers,
+                variant,
+                depth,
+                win_threshold,
+                unclear_threshold,
+                mate_distance_ratio,
+                clean_distance,
+                mate_only,
+                failed_file,
+                timeout,
+                progress_callback,
+                use_tqdm=False,
+                ordered=ordered,
+                cache_path=cache_path,
+                cache_size=cache_size,
+                dump_file=dump_file,
+                clear_hash=clear_hash,
+                prune_depth=prune_depth,
+                prune_margin=prune_margin,
+                triage_depths=triage_depths,
+                triage_margin=triage_margin,
+                journal=journal,
+            )
+
+        engine = uci.Engine([engine_path], options)
+        engine.setoption('multipv', multipv)
+        sf.set_option("VariantPath", engine.options.get("VariantPath", ""))
+        cache = AnalysisCache(cache_path, cache_size, engine_fingerprint(engine_path, options)) if cache_path else None
+        try:
+            stats = generate_puzzles(
+                instream,
+                outstream,
+                engine,
+                variant,
+                depth,
+                win_threshold,
+                unclear_threshold,
+                mate_distance_ratio,
+                clean_distance,
+                mate_only,
+                failed_file,
+                timeout,
+                progress_callback,
+                use_tqdm=False,
+                cache=cache,
+                dump_file=dump_file,
+                clear_hash=clear_hash,
+                prune_depth=prune_depth,
+                prune_margin=prune_margin,
+                triage_depths=triage_depths,
+                triage_margin=triage_margin,
+                journal=journal,
+            )
+        finally:
+            if cache:
+                cache.close()
+        return stats
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('epd_files', nargs='*')
-    parser.add_argument('-e', '--engine', required=True)
+    parser.add_argument('-e', '--engine', help='required unless rescoring')
     parser.add_argument('-o', '--ucioptions', type=lambda kv: kv.split("="), action='append', default=[],
                         help='UCI option as key=value pair. Repeat to add more options.')
     parser.add_argument('-v', '--variant', help='only required if not annotated in input FEN/EPD')
@@ -328,11 +704,57 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--clean-distance', type=int, default=0, help='number of moves where a mate puzzle needs to have no other win')
     parser.add_argument('--mate-only', action='store_true', help='do not generate puzzles other than mates (small speedup)')
     parser.add_argument('-f', '--failed-file', help='output file name for epd lines producing no puzzle')
-    parser.add_argument('-t', '--timeout', type=int, default=600, help='maximum time to analysis a single fen in seconds')
+    parser.add_argument('-t', '--timeout', type=int, default=600, help='maximum time to analysis a single fen in seconds, 0 for no limit')
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel engine processes')
+    parser.add_argument('--unordered', action='store_true', help='write puzzles as soon as they are found instead of in input order')
+    parser.add_argument('--split-options', action='store_true', help='treat Threads and Hash as totals shared evenly among worker engines')
+    parser.add_argument('--cache', help='file to store engine analysis in and reuse it from on later runs with the same engine and options')
+    parser.add_argument('--cache-size', type=int, default=1000000, help='maximum number of positions kept in the analysis cache')
+    parser.add_argument('--dump-infos', help='output file name for the raw analysis of every searched position')
+    parser.add_argument('--clear-hash', choices=CLEAR_HASH_POLICIES, default='puzzle', help='when to clear the engine hash: before each puzzle, at the start of each input file, or never (default: puzzle)')
+    parser.add_argument('--prune-depth', type=int, default=0, help='stop searches from this depth on once a position is clearly no puzzle (default: off)')
+    parser.add_argument('--prune-margin', type=float, default=0.5, help='fraction of the required best move advantage below which a position counts as clearly no puzzle')
+    parser.add_argument('--triage-depth', type=int, action='append', default=[],
+                        help='depth of a shallow search discarding clear non-puzzles before the full search. Repeat for more stages.')
+    parser.add_argument('--triage-margin', type=float, default=0.5, help='like --prune-margin, but for triage searches')
+    parser.add_argument('--rescore', action='store_true', help='recompute puzzles from files written by --dump-infos without an engine')
+    parser.add_argument('--output', help='output file, with a journal of processed lines to resume from (default: stdout)')
+    parser.add_argument('--resume', action='store_true', help='skip input lines an interrupted run already processed')
     args = parser.parse_args()
-
-    engine = uci.Engine([args.engine], dict(args.ucioptions))
-    engine.setoption('multipv', args.multipv)
-    sf.set_option("VariantPath", engine.options.get("VariantPath", ""))
+    if not args.engine and not args.rescore:
+        parser.error('the following arguments are required: -e/--engine')
+    if args.resume and (not args.output or args.rescore):
+        parser.error('--resume requires --output and is not supported for --rescore')
+
+    ucioptions = dict(args.ucioptions)
+    if args.split_options:
+        ucioptions = split_engine_options(ucioptions, args.workers)
+    journal = None
+    outstream = sys.stdout
+    if args.output and not args.rescore:
+        journal = Journal.for_output(args.output, args.failed_file, args.dump_infos, args.resume)
+        outstream = open(args.output, 'a' if args.resume else 'w', encoding='utf8')
+    elif args.output:
+        outstream = open(args.output, 'w', encoding='utf8')
     with fileinput.input(args.epd_files, encoding='utf8') as instream:
-        generate_puzzles(instream, sys.stdout, engine, args.variant, args.depth, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file, args.timeout)
+        if args.rescore:
+            sf.set_option("VariantPath", ucioptions.get("VariantPath", ""))
+            rescore_puzzles(instream, outstream, args.variant, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file)
+        elif args.workers > 1:
+            stats = generate_puzzles_parallel(instream, outstream, args.engine, ucioptions, args.multipv, args.workers, args.variant, args.depth, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file, args.timeout, ordered=not args.unordered, cache_path=args.cache, cache_size=args.cache_size, dump_file=args.dump_infos, clear_hash=args.clear_hash, prune_depth=args.prune_depth, prune_margin=args.prune_margin, triage_depths=args.triage_depth, triage_margin=args.triage_margin, journal=journal)
+        else:
+            engine = uci.Engine([args.engine], ucioptions)
+            engine.setoption('multipv', args.multipv)
+            sf.set_option("VariantPath", engine.options.get("VariantPath", ""))
+            cache = AnalysisCache(args.cache, args.cache_size, engine_fingerprint(args.engine, ucioptions)) if args.cache else None
+            try:
+                stats = generate_puzzles(instream, outstream, engine, args.variant, args.depth, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file, args.timeout, cache=cache, dump_file=args.dump_infos, clear_hash=args.clear_hash, prune_depth=args.prune_depth, prune_margin=args.prune_margin, triage_depths=args.triage_depth, triage_margin=args.triage_margin, journal=journal)
+            finally:
+                if cache:
+                    cache.close()
+        if args.triage_depth and not args.rescore:
+            report_triage(stats, sorted(args.triage_depth), args.depth)
+    if args.output:
+        outstream.close()
+    if journal:
+        journal.close()
@@ -0,0 +1,112 @@
+from array import array
+import hashlib
+import math
+
+
+class BloomFilter():
+    """Set of strings with bounded memory and a configurable false positive rate.
+
+    Sized for capacity keys, membership tests wrongly succeed for about error_rate of the
+    keys not added before. Keys are never reported missing once added, unless max_size
+    keys are stored: then the filter forgets all keys like HashSet, before it saturates.
+    """
+
+    def __init__(self, capacity, error_rate=0.001, max_size=None):
+        capacity = max(1, capacity)
+        self.max_size = max_size
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._clear()
+
+    def _clear(self):
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        positions = self._positions(key)
+        if all(self.bits[p >> 3] & (1 << (p & 7)) for p in positions):
+            return
+        if self.max_size and self.count >= self.max_size:
+            self._clear()
+        for p in positions:
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+def key_hash(key):
+    """Non-zero 64 bit hash of a string."""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class HashSet():
+    """Set of strings stored as 64 bit hashes in an array based open addressing table.
+
+    Takes 16-32 bytes per key. Keys with equal 64 bit hashes count as equal, which is
+    negligible below billions of keys. Once max_size keys are stored, the set forgets
+    all keys, so memory stays flat on endless runs at the cost of repeating old keys.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._clear(1024)
+
+    def _clear(self, capacity):
+        # zero marks empty slots, the table is kept at most half full
+        self.table = array('Q', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.count = 0
+
+    def _slot(self, h):
+        table = self.table
+        i = h & self.mask
+        while table[i] and table[i] != h:
+            i = (i + 1) & self.mask
+        return i
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        h = key_hash(key)
+        return self.table[self._slot(h)] == h
+
+    def add(self, key):
+        h = key_hash(key)
+        i = self._slot(h)
+        if self.table[i] == h:
+            return
+        if self.max_size and self.count >= self.max_size:
+            self._clear(len(self.table))
+            i = self._slot(h)
+        self.table[i] = h
+        self.count += 1
+        if 2 * self.count > len(self.table):
+            self._grow()
+
+    def _grow(self):
+        old = self.table
+        self._clear(2 * len(old))
+        for h in old:
+            if h:
+                self.table[self._slot(h)] = h
+                self.count += 1
+
+
+def seen_set(max_size=None, error_rate=0, capacity=1000000):
+    """Set for deduplication, approximated by a Bloom filter for a positive error_rate.
+
+    The Bloom filter is sized for max_size keys, or capacity keys if max_size is not given.
+    Either set forgets all keys once it holds max_size of them.
+    """
+    if error_rate:
+        return BloomFilter(max_size or capacity, error_rate, max_size)
+    return HashSet(max_size)
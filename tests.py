@@ -1,9 +1,60 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import fileinput
 from io import StringIO
+import os
+import random
+import tempfile
+import time
 import unittest
 import sys
 
+import cshogi
+import pyffish as sf
+
+import deduplicate
+import epdsort
+import filter as puzzle_filter
+import parallel
 import pgn
+from game import GameState
+import generator
 import kif
+from analysis_cache import AnalysisCache, engine_fingerprint
+import puzzler
+import seen
+import uci
+
+
+# minimal UCI engine printing two PV lines per depth, stopping on request
+FAKE_ENGINE = '''
+import sys, threading
+stop = threading.Event()
+def search(depth):
+    for d in range(1, depth + 1):
+        if stop.wait(0.01):
+            break
+        for multipv, move in ((1, 'e2e4'), (2, 'd2d4')):
+            print('info depth {} multipv {} score cp {} pv {}'.format(d, multipv, 100 // multipv, move), flush=True)
+    print('bestmove e2e4', flush=True)
+searcher = None
+for line in sys.stdin:
+    command = line.split() or ['']
+    if command[0] == 'uci':
+        print('uciok', flush=True)
+    elif command[0] == 'isready':
+        print('readyok', flush=True)
+    elif command[0] == 'go':
+        stop.clear()
+        searcher = threading.Thread(target=search, args=(int(command[command.index('depth') + 1]),))
+        searcher.start()
+    elif command[0] == 'stop' and searcher:
+        stop.set()
+        searcher.join()
+    elif command[0] == 'quit':
+        break
+'''
+FAKE_ENGINE_ARGS = [sys.executable, '-c', FAKE_ENGINE]
 
 
 class TestPgn(unittest.TestCase):
@@ -27,6 +78,19 @@ class TestPgn(unittest.TestCase):
         pgn.epd_to_pgn(instream, outstream)
         self.assertIn('31... Nef2+ 32. Qxf2 Nxf2+', outstream.getvalue())
 
+    def test_movetext(self):
+        self.assertEqual(pgn.movetext('8/8/8/8/8/8/8/8 w - - 0 7', ['e4', 'e5', 'Nf3']), '7. e4 e5 8. Nf3 ')
+        # EPD FENs without move counters
+        self.assertEqual(pgn.movetext('8/8/8/8/8/8/8/8 b KQkq -', ['e5', 'Nf3']), '1... e5 2. Nf3 ')
+
+    def test_parallel(self):
+        epds = [self.TEST_PUZZLE.replace(' 31;', ' {};'.format(i)) + '\n' for i in range(1, 6)]
+        outstream = StringIO()
+        pgn.epd_to_pgn(iter(epds), outstream)
+        parallel_outstream = StringIO()
+        pgn.epd_to_pgn_parallel(iter(epds), parallel_outstream, workers=2, chunk_size=2)
+        self.assertEqual(parallel_outstream.getvalue(), outstream.getvalue())
+
 
 class TestKif(unittest.TestCase):
     # Shogi puzzle in EPD format - using default start position with some moves
@@ -50,6 +114,11 @@ class TestKif(unittest.TestCase):
         self.assertIsNone(kif.pyffish_to_usi_square('a0', 'shogi'))
         self.assertIsNone(kif.pyffish_to_usi_square('', 'shogi'))
 
+        # Test precomputed tables
+        self.assertEqual(len(kif.usi_square_table('shogi')), 81)
+        self.assertEqual(len(kif.usi_square_table('minishogi')), 25)
+        self.assertIs(kif.usi_square_table('shogi'), kif.usi_square_table('shogi'))
+
     def test_move_conversion(self):
         """Test pyffish UCI to USI move conversion"""
         # Normal moves for 9x9 shogi
@@ -107,6 +176,19 @@ class TestKif(unittest.TestCase):
         finally:
             sys.stderr = original_stderr
 
+    def test_stream_exporter(self):
+        """Test KIF exporter writing to an in-memory stream"""
+        board = cshogi.Board()
+        stream = StringIO()
+        exporter = kif.StreamExporter(stream)
+        exporter.header(['先手', '後手'])
+        exporter.move(board.move_from_usi('7g7f'))
+        exporter.end('resign')
+        exporter.close()
+        self.assertFalse(stream.closed)
+        self.assertIn('   1 ７六歩(77)', stream.getvalue())
+        self.assertIn('まで1手で先手の勝ち', stream.getvalue())
+
     def test_kif_export_non_shogi(self):
         """Test KIF export skips non-shogi variants"""
         non_shogi_puzzle = '3r4/2Rpk1pp/p2pp1b1/3p2N1/1Q1PnBPn/3bPP1n/P2Q3P/R6K[RBPPP] b - - 4 31;variant crazyhouse;pv e4f2,d2f2,h3f2'
@@ -156,5 +238,419 @@ class TestKif(unittest.TestCase):
             sys.stderr = original_stderr
 
 
+class TestUci(unittest.TestCase):
+    OUTPUT = [
+        'info string NNUE evaluation using chess.nnue enabled\n',
+        'info depth 1 seldepth 1 multipv 1 score cp 40 nodes 20 nps 10000 time 2 pv e2e4\n',
+        'info depth 1 seldepth 1 multipv 2 score cp 30 nodes 20 nps 10000 time 2 pv d2d4\n',
+        'info depth 2 seldepth 3 multipv 1 score cp 60 lowerbound nodes 50 nps 10000 time 5 pv e2e4\n',
+        'info depth 2 seldepth 3 multipv 1 score cp 35 nodes 80 nps 10000 hashfull 0 tbhits 0 time 8 pv e2e4 e7e5\n',
+        'info depth 2 seldepth 2 multipv 2 score mate -3 nodes 90 nps 10000 time 9 pv d2d4 d7d5\n',
+        'info depth 3 currmove e2e4 currmovenumber 1\n',
+        'bestmove e2e4 ponder e7e5\n',
+    ]
+
+    def test_parse_info(self):
+        self.assertEqual(uci.parse_info(self.OUTPUT[4]), {'depth': 2, 'multipv': 1, 'score': ['cp', '35'], 'pv': ['e2e4', 'e7e5']})
+        self.assertIsNone(uci.parse_info(self.OUTPUT[0]))
+        self.assertIsNone(uci.parse_info(self.OUTPUT[3]))
+        self.assertIsNone(uci.parse_info(self.OUTPUT[6]))
+
+    def test_parse_search_output(self):
+        bestmove, infos = uci.parse_search_output(self.OUTPUT)
+        self.assertEqual(bestmove, 'e2e4')
+        self.assertEqual([[info['multipv'] for info in multipv_info] for multipv_info in infos], [[1, 2], [1, 2]])
+        self.assertEqual(infos[1][0]['score'], ['cp', '35'])
+        self.assertEqual(infos[1][1]['score'], ['mate', '-3'])
+
+    def test_async_engine(self):
+        async def run():
+            engine = await uci.AsyncEngine.create(FAKE_ENGINE_ARGS, {'multipv': 2})
+            self.assertEqual(engine.sent_options, {'multipv': '2'})
+            await engine.setoption('MultiPV', 2)
+            await engine.newgame()
+            await engine.position()
+            bestmove, infos = await engine.go(depth=3)
+            self.assertEqual(bestmove, 'e2e4')
+            self.assertEqual([[info['multipv'] for info in multipv_info] for multipv_info in infos], [[1, 2]] * 3)
+            # cancelling stops the search and leaves the engine ready for the next one
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(engine.go(depth=1000), 0.05)
+            bestmove, infos = await engine.go(depth=2)
+            self.assertEqual(len(infos), 2)
+            await engine.quit()
+        asyncio.run(run())
+
+
+class TestPruning(unittest.TestCase):
+    @staticmethod
+    def info(depth, score1, score2):
+        return [[{'depth': depth, 'multipv': 1, 'score': score1.split(), 'pv': ['e2e4']},
+                 {'depth': depth, 'multipv': 2, 'score': score2.split(), 'pv': ['d2d4']}]]
+
+    def test_puzzle_gap(self):
+        self.assertAlmostEqual(puzzler.puzzle_gap(self.info(5, 'cp 400', 'cp 100')[-1], 400, 100), 1)
+        self.assertEqual(puzzler.puzzle_gap(self.info(5, 'cp 30', 'cp 30')[-1], 400, 100), 0)
+
+    def test_is_clearly_no_puzzle(self):
+        prune = dict(prune_depth=4, prune_margin=0.5, win_threshold=400, unclear_threshold=100)
+        self.assertTrue(puzzler.is_clearly_no_puzzle(self.info(5, 'cp 30', 'cp 20'), **prune))
+        self.assertFalse(puzzler.is_clearly_no_puzzle(self.info(3, 'cp 30', 'cp 20'), **prune))
+        self.assertFalse(puzzler.is_clearly_no_puzzle(self.info(5, 'cp 500', 'cp 20'), **prune))
+        self.assertFalse(puzzler.is_clearly_no_puzzle(self.info(5, 'mate 3', 'mate 4'), **prune))
+
+    def test_pruned_nodes_not_recorded(self):
+        engine = uci.Engine(FAKE_ENGINE_ARGS, {'multipv': 2})
+        start_fen = sf.start_fen('chess')
+        nodes = {}
+        _, info = puzzler.get_puzzle('chess', start_fen, [], engine, 5, 400, 100, 1.5, nodes=nodes, stop_when=lambda infos: len(infos) >= 2)
+        self.assertEqual(info[-1][0]['depth'], 2)
+        self.assertEqual(nodes, {})
+        puzzler.get_puzzle('chess', start_fen, [], engine, 3, 400, 100, 1.5, nodes=nodes)
+        self.assertEqual(nodes[''][-1][0]['depth'], 3)
+
+
+class TestSeen(unittest.TestCase):
+    def test_bloom_filter(self):
+        bloom = seen.BloomFilter(1000, 0.01)
+        keys = ['fen {}'.format(i) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum('other {}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_hash_set(self):
+        hashes = seen.HashSet()
+        keys = ['fen {}'.format(i) for i in range(5000)]
+        for key in keys + keys[:100]:
+            hashes.add(key)
+        self.assertEqual(len(hashes), 5000)
+        self.assertTrue(all(key in hashes for key in keys))
+        self.assertFalse(any('other {}'.format(i) in hashes for i in range(5000)))
+
+    def test_hash_set_limit(self):
+        hashes = seen.HashSet(max_size=100)
+        for i in range(250):
+            hashes.add('fen {}'.format(i))
+        self.assertEqual(len(hashes), 50)
+        self.assertEqual(len(hashes.table), 1024)
+        self.assertIn('fen 249', hashes)
+        self.assertNotIn('fen 0', hashes)
+
+    def test_bloom_filter_limit(self):
+        bloom = seen.seen_set(max_size=1000, error_rate=0.01)
+        for i in range(20000):
+            bloom.add('fen {}'.format(i))
+        self.assertIn('fen 19999', bloom)
+        false_positives = sum('other {}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class TestGameState(unittest.TestCase):
+    def test_matches_full_replay(self):
+        start_fen = sf.start_fen('chess')
+        # knight moves repeat the start position, the pawn move re-bases
+        moves = ['g1f3', 'g8f6', 'f3g1', 'f6g8', 'e2e4', 'b8c6', 'g1f3', 'c6b8', 'f3g1', 'b8c6', 'g1f3', 'c6b8', 'f3g1']
+        game = GameState('chess', start_fen)
+        for i, move in enumerate(moves):
+            self.assertEqual(game.fen, sf.get_fen('chess', start_fen, moves[:i]))
+            self.assertEqual(sorted(game.legal_moves()), sorted(sf.legal_moves('chess', start_fen, moves[:i])))
+            game.push(move)
+        self.assertEqual(game.moves, moves[5:])
+        self.assertTrue(game.is_optional_game_end())
+
+    def test_normalized_start(self):
+        start_fen = 'lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL[-] w 0 1'
+        self.assertEqual(GameState('shogi', start_fen).fen, sf.get_fen('shogi', start_fen, []))
+        start_fen = sf.start_fen('fischerandom')
+        self.assertEqual(GameState('fischerandom', start_fen).fen, sf.get_fen('fischerandom', start_fen, []))
+
+    def test_repetition_across_capture(self):
+        start_fen = '4k3/8/8/8/8/8/8/4K3[Nn] w - - 0 1'
+        # the captured knights return to the pockets, so the start position repeats
+        moves = 'N@e7 e8e7 e1e2 N@e3 e2e3 e7e8 e3e2 e8d8 e2e1 d8e8 e1e2 e8d8 e2e1 d8e8'.split()
+        game = GameState('crazyhouse', start_fen, moves)
+        self.assertEqual(game.fen, sf.get_fen('crazyhouse', start_fen, moves))
+        self.assertTrue(sf.is_optional_game_end('crazyhouse', start_fen, moves)[0])
+        self.assertTrue(game.is_optional_game_end())
+
+
+class TestGenerator(unittest.TestCase):
+    def test_occupied_squares(self):
+        self.assertEqual(generator.occupied_squares('k7/8/8/8/8/8/8/7K w - - 0 1'), {'a8', 'h1'})
+        self.assertEqual(generator.occupied_squares('4k5/10/10/10/10/10/10/10/10/5K4[Pp] w - - 0 1'), {'e10', 'f1'})
+
+    def test_random_move_source(self):
+        positions = generator.generate_fens(None, 'chess', 1, 1, True, None, move_source='random')
+        for fen, move in [next(positions) for _ in range(50)]:
+            self.assertIn(move, sf.legal_moves('chess', fen, []))
+
+    def test_seeded_batches(self):
+        # games end by the 50 move rule within a few moves
+        fens = ['k7/8/1K6/8/8/8/8/7Q w - - 90 1', 'k7/8/1K6/8/8/8/8/7R w - - 90 1']
+
+        def batch(seed):
+            return list(generator.generate_fens(None, 'chess', 1, 1, False, None, fens, move_source='random',
+                                                rng=random.Random(seed), count=10))
+        self.assertEqual(batch('1:0'), batch('1:0'))
+        self.assertNotEqual(batch('1:0'), batch('1:1'))
+        self.assertGreaterEqual(len(batch('1:0')), 10)
+
+
+class TestParallel(unittest.TestCase):
+    @staticmethod
+    def slow_square(x):
+        time.sleep(0.01 * (5 - x))
+        return x * x
+
+    def test_ordered(self):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(parallel.imap(executor, self.slow_square, range(5), 3))
+        self.assertEqual(results, [0, 1, 4, 9, 16])
+
+    def test_unordered(self):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(parallel.imap(executor, self.slow_square, range(5), 3, ordered=False))
+        self.assertEqual(sorted(results), [0, 1, 4, 9, 16])
+
+    def test_split_engine_options(self):
+        options = puzzler.split_engine_options({'Threads': '8', 'Hash': '1000', 'EvalFile': 'x.nnue'}, 3)
+        self.assertEqual(options, {'Threads': 2, 'Hash': 333, 'EvalFile': 'x.nnue'})
+        self.assertEqual(puzzler.split_engine_options({'Threads': 2}, 4)['Threads'], 1)
+
+
+class TestAnalysisCache(unittest.TestCase):
+    INFOS = [[{'depth': d, 'multipv': m, 'score': ['cp', str(10 * d + m)], 'pv': ['e2e4']} for m in (1, 2, 3)] for d in (1, 2, 3, 4)]
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.cache = AnalysisCache(self.path, max_entries=2)
+
+    def tearDown(self):
+        self.cache.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def test_serves_shallower_requests(self):
+        self.cache.put('chess', 'startfen', ['e2e4'], 4, 3, self.INFOS)
+        infos = self.cache.get('chess', 'startfen', ['e2e4'], 2, 2)
+        self.assertEqual(len(infos), 2)
+        self.assertEqual([len(multipv_info) for multipv_info in infos], [2, 2])
+        self.assertEqual(infos[-1][1]['score'], ['cp', '22'])
+
+    def test_misses_deeper_requests(self):
+        self.cache.put('chess', 'startfen', [], 4, 3, self.INFOS)
+        self.assertIsNone(self.cache.get('chess', 'startfen', [], 5, 2))
+        self.assertIsNone(self.cache.get('chess', 'startfen', [], 4, 4))
+        self.assertIsNone(self.cache.get('chess', 'startfen', ['e2e4'], 4, 2))
+
+    def test_keeps_deeper_analysis(self):
+        self.cache.put('chess', 'startfen', [], 4, 3, self.INFOS)
+        self.cache.put('chess', 'startfen', [], 2, 3, self.INFOS[:2])
+        self.assertEqual(len(self.cache.get('chess', 'startfen', [], 4, 3)), 4)
+
+    def test_eviction(self):
+        for i in range(3):
+            self.cache.put('chess', 'fen{}'.format(i), [], 4, 3, self.INFOS)
+        self.cache.get('chess', 'fen0', [], 4, 3)
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.get('chess', 'fen0', [], 4, 3))
+        self.assertIsNone(self.cache.get('chess', 'fen1', [], 4, 3))
+        self.assertIsNotNone(self.cache.get('chess', 'fen2', [], 4, 3))
+
+    def test_evicted_after_workers(self):
+        self.cache.close()
+        engine_path = os.path.join(os.path.dirname(self.path), 'fake_engine_{}'.format(os.getpid()))
+        with open(engine_path, 'w') as f:
+            f.write('#!{}\n{}'.format(sys.executable, FAKE_ENGINE))
+        os.chmod(engine_path, 0o755)
+        try:
+            epds = ''.join(sf.get_fen('chess', sf.start_fen('chess'), moves) + ';variant chess\n'
+                           for moves in ([], ['g1f3', 'g8f6'], ['b1c3', 'b8c6'], ['g1h3', 'g8h6']))
+            puzzler.generate_puzzles_parallel(StringIO(epds), StringIO(), engine_path, {}, 2, 2, None, 3, 400, 100, 1.5, 0, False, None, 10,
+                                              use_tqdm=False, cache_path=self.path, cache_size=1)
+        finally:
+            os.unlink(engine_path)
+        self.cache = AnalysisCache(self.path)
+        self.assertEqual(self.cache.connection.execute('SELECT COUNT(*) FROM analysis').fetchone()[0], 1)
+
+    def test_engine_fingerprint(self):
+        engine = engine_fingerprint('stockfish', {'EvalFile': 'a.nnue', 'Threads': 4})
+        self.assertEqual(engine, engine_fingerprint('stockfish', {'evalfile': 'a.nnue', 'Threads': 1, 'multipv': 3}))
+        self.cache.close()
+        self.cache = AnalysisCache(self.path, engine=engine)
+        self.cache.put('chess', 'startfen', [], 4, 3, self.INFOS)
+        self.cache.close()
+        self.cache = AnalysisCache(self.path, engine=engine)
+        self.assertIsNotNone(self.cache.get('chess', 'startfen', [], 4, 3))
+        self.cache.close()
+        self.cache = AnalysisCache(self.path, engine=engine_fingerprint('stockfish', {'EvalFile': 'b.nnue'}))
+        self.assertIsNone(self.cache.get('chess', 'startfen', [], 4, 3))
+
+
+class TestRescore(unittest.TestCase):
+    RECORD = {
+        'epd': 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1;variant chess\n',
+        'nodes': {'': [[{'depth': 1, 'multipv': 1, 'score': ['cp', '900'], 'pv': ['e2e4']},
+                        {'depth': 1, 'multipv': 2, 'score': ['cp', '0'], 'pv': ['d2d4']}]]},
+    }
+
+    def test_rescore(self):
+        puzzle = puzzler.rescore_epd(self.RECORD, None, 400, 100, 1.5, 0, False)
+        self.assertIn(';type winning;', puzzle)
+        self.assertIn(';bm e2e4;', puzzle)
+
+    def test_rescore_thresholds(self):
+        puzzle = puzzler.rescore_epd(self.RECORD, None, 1000, 100, 1.5, 0, False)
+        self.assertIn(';type turnaround;', puzzle)
+        self.assertIsNone(puzzler.rescore_epd(self.RECORD, None, 2000, 0, 1.5, 0, False))
+
+
+class TestDeduplicate(unittest.TestCase):
+    @staticmethod
+    def random_puzzles(rng, count):
+        squares = ['{}{}'.format(f, r) for f in 'abcd' for r in '1234']
+        return [{'board': frozenset((sq, rng.choice('KQRp')) for sq in rng.sample(squares, rng.randint(2, 8))),
+                 'sans': tuple(rng.choice(['Qh7#', 'Rxe8', 'Kg2', 'd4']) for _ in range(rng.randint(0, 5)))}
+                for _ in range(count)]
+
+    def test_large_board(self):
+        pieces = deduplicate.fen_to_square_map('r10k/12/12/12/12/12/12/12/12/K11 w - - 0 1')
+        self.assertEqual(pieces, {'a10': 'r', 'l10': 'k', 'a1': 'K'})
+
+    def test_extract_features_in_order(self):
+        epds = ['{};variant chess;pv {}\n'.format(sf.start_fen('chess'), move) for move in ('e2e4', 'd2d4', 'g1f3')] * 30
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            puzzles = list(deduplicate.extract_features(epds, 'k', executor, 3))
+        self.assertEqual([puzzle['epd'] for puzzle in puzzles], epds)
+        self.assertEqual(puzzles[2]['sans'], ('Nf3',))
+        self.assertEqual(puzzles[2]['pattern'], 'N-f3-k-e8')
+
+    def test_index_matches_brute_force(self):
+        rng = random.Random(1)
+        puzzles = self.random_puzzles(rng, 300)
+        for thresholds in ((0.8, 0.8, 0.5), (0.6, 0.5, 0.3), (0.95, 1, 0.9), (0, 0, 0), (1, 1, 1)):
+            index = deduplicate.SimilarityIndex(*thresholds, rank=deduplicate.rarity_rank(puzzles[:50]))
+            kept = []
+            for puzzle in puzzles:
+                expected = next((p for p in kept if any(s > t for s, t in zip(deduplicate.similarity(puzzle, p), thresholds))), None)
+                match = index.find(puzzle)
+                self.assertIs(match and match[0], expected)
+                if not expected and rng.random() < 0.5:
+                    kept.append(puzzle)
+                    index.add(puzzle)
+
+    def test_no_moves(self):
+        puzzle = {'board': frozenset([('a1', 'K')]), 'sans': ()}
+        index = deduplicate.SimilarityIndex(0.8, 0.8, 0.5)
+        index.add({'board': frozenset([('a1', 'K')]), 'sans': ('Qh7#',)})
+        self.assertEqual(index.find(puzzle)[1], (1.0, 0.0, 0.0))
+        self.assertEqual(deduplicate.similarity(puzzle, index.puzzles[0]), (1.0, 0, 0.0))
+
+
+class TestEpdSort(unittest.TestCase):
+    LINES = ['8/8/8 w - - 0 1;rating {};name {}\n'.format(r, n)
+             for r, n in [(1500, 'ab'), (900, 'a'), ('', 'b'), (1500, 'a'), (900, 'ab'), ('x', 'b')]]
+
+    def test_mixed_types(self):
+        ratings = [line.split(';')[1] for line in epdsort.sort_epds(self.LINES, [['rating', 'd']])]
+        self.assertEqual(ratings, ['rating 1500', 'rating 1500', 'rating 900', 'rating 900', 'rating x', 'rating '])
+
+    def test_descending_text(self):
+        names = [line.split(';')[2].strip() for line in epdsort.sort_epds(self.LINES, [['name', 'd']])]
+        self.assertEqual(names, ['name b', 'name b', 'name ab', 'name ab', 'name a', 'name a'])
+
+    def test_external_sort_is_stable(self):
+        lines = self.LINES * 20
+        criteria = [['rating', 'a']]
+        self.assertEqual(list(epdsort.sort_epds(iter(lines), criteria, chunk_size=7)),
+                         sorted(lines, key=lambda epd: epdsort.sort_key(criteria, epd)))
+
+
+class TestFilter(unittest.TestCase):
+    EPD = '6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1;variant chess;rating 1600;pv d1d8\n'
+
+    def test_lazy_annotations(self):
+        calls = []
+        inferred = puzzle_filter.make_inferred_annotations({'p': 1, 'r': 5})
+        inferred['finalmaterial'] = lambda fen, annotations, f=inferred['finalmaterial']: calls.append(1) or f(fen, annotations)
+        annotations = puzzle_filter.Annotations(self.EPD.split(';')[0], {'variant': 'chess', 'pv': 'd1d8', 'material': '9'}, inferred)
+        self.assertFalse(calls)
+        self.assertEqual(annotations['material'], 5)
+        self.assertEqual(annotations.get('materialdiff'), 0)
+        self.assertEqual(annotations.get('finalmaterial'), 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_inferred_errors_propagate(self):
+        inferred = puzzle_filter.make_inferred_annotations({'p': 1, 'r': 5})
+        annotations = puzzle_filter.Annotations(self.EPD.split(';')[0], {'pv': 'd1d8'}, inferred)
+        self.assertIsNone(annotations.get('missing'))
+        with self.assertRaises(KeyError):
+            annotations.get('materialdiff', 0)
+
+    def test_criteria(self):
+        inferred = puzzle_filter.make_inferred_annotations({'p': 1, 'r': 5})
+        def rejects(min={}, max={}, values={}):
+            return puzzle_filter.Criteria(min, max, values, inferred).rejects(self.EPD)
+        self.assertFalse(rejects({'rating': '1500', 'pv': '1'}, {'material': '5'}, {'variant': 'chess,atomic'}))
+        self.assertTrue(rejects(min={'pv': '2'}))
+        self.assertTrue(rejects(max={'rating': '1500'}))
+        self.assertTrue(rejects(values={'type': 'mate'}))
+        self.assertTrue(rejects(min={'missing': '1'}))
+        self.assertTrue(rejects(min={'materialdiff': '1'}))
+
+    def test_chunks(self):
+        lines = [self.EPD.replace('1600', str(rating)) for rating in range(1000, 1100)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'puzzles.epd')
+            with open(path, 'w') as f:
+                f.writelines(lines)
+            results = [puzzle_filter._filter_chunk({'rating': '1050'}, {}, {}, {}, chunk)
+                       for chunk in puzzle_filter.file_chunks([path], 100)]
+        self.assertEqual([line for chunk in results for line in chunk], lines[50:])
+
+
+class TestJournal(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'puzzles.epd')
+            with open(output, 'w') as f:
+                f.write('puzzle 0\npartial')
+            with open(output + '.journal', 'w') as f:
+                f.write('0 9 0 0\n2 9 0 0\n3 1')
+            journal = puzzler.Journal.for_output(output, resume=True)
+            self.assertEqual(list(journal.pending(['a', 'b', 'c', 'd'])), [(1, 'b'), (3, 'd')])
+            with open(output) as out:
+                out.seek(0, os.SEEK_END)
+                journal.record(1, out, None, None)
+            journal.close()
+            with open(output) as f:
+                self.assertEqual(f.read(), 'puzzle 0\n')
+            with open(output + '.journal') as f:
+                self.assertEqual(f.read(), '0 9 0 0\n2 9 0 0\n1 9 0 0\n')
+
+    def test_input_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ('a.epd', 'b.epd')]
+            for path, lines in zip(paths, ('a\nb\n', 'c\n')):
+                with open(path, 'w') as f:
+                    f.write(lines)
+            with fileinput.input(paths) as instream:
+                self.assertEqual(list(puzzler.input_lines(instream, {1})), [(0, 'a\n', 0), (2, 'c\n', 1)])
+
+    def test_resume_without_journal(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'puzzles.epd')
+            with open(output, 'w') as f:
+                f.write('puzzle 0\n')
+            journal = puzzler.Journal.for_output(output, resume=True)
+            journal.close()
+            self.assertFalse(journal.resumed)
+            self.assertEqual(os.path.getsize(output), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,58 @@
+import asyncio
 import subprocess
 import threading
-from collections.abc import Iterable
-from collections import defaultdict
+from collections import namedtuple
+
+
+SearchResult = namedtuple('SearchResult', ['bestmove', 'infos', 'timed_out'])
+
+
+def parse_info(line):
+    """Parse the depth, multipv, score and pv of an info line.
+
+    Returns None for other output and for lower/upper bound scores of aspiration searches.
+    """
+    if not line.startswith('info') or ' score ' not in line:
+        return None
+    items = line.split()
+    if items[1] == 'string':
+        return None
+    score = items.index('score') + 1
+    if items[score + 2:score + 3] in (['lowerbound'], ['upperbound']):
+        return None
+    info = {'depth': int(items[items.index('depth') + 1]) if 'depth' in items else None,
+            'multipv': int(items[items.index('multipv') + 1]) if 'multipv' in items else 1,
+            'score': items[score:score + 2]}
+    if 'pv' in items:
+        info['pv'] = items[items.index('pv') + 1:]
+    return info
+
+
+def parse_search_output(lines):
+    """Parse the engine output of a go command into the bestmove and the infos per depth and multipv."""
+    bestmove = None
+    infos = {}
+    for line in lines:
+        if line.startswith('bestmove'):
+            bestmove = line.split()[1]
+            continue
+        info = parse_info(line)
+        if info:
+            infos.setdefault(info['depth'], {})[info['multipv']] = info
+    return bestmove, _sorted_infos(infos)
+
+
+def _sorted_infos(infos):
+    return [[infos[d][m] for m in sorted(infos[d])] for d in sorted(infos)]
 
 
 class Engine():
     def __init__(self, args, options=None):
         self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
         self.lock = threading.Lock()
+        self.deadline_lock = threading.Lock()
         self.options = options or {}
+        self.sent_options = {}
         self._init()
 
     def __del__(self):
@@ -25,12 +69,17 @@ class Engine():
             self.process.stdin.flush()
 
     def setoption(self, name, value):
+        # option names are case insensitive, only send values the engine does not have yet
+        if self.sent_options.get(name.lower()) == str(value):
+            return
+        self.options[name] = value
+        self.sent_options[name.lower()] = str(value)
         self.write('setoption name {} value {}\n'.format(name, value))
 
     def _init(self):
         self.write('uci\n')
         self.read('uciok')
-        for option, value in self.options.items():
+        for option, value in list(self.options.items()):
             self.setoption(option, value)
 
     def newgame(self):
@@ -43,36 +92,81 @@ class Engine():
         moves = 'moves {}'.format(' '.join(moves)) if moves else ''
         self.write('position {} {}\n'.format(sfen, moves))
 
-    def go(self, **limits):
-        self.write('go {}\n'.format(' '.join(str(item) for key_value in limits.items() for item in key_value)))
+    def go(self, stop_when=None, **limits):
+        """Run a search and return the bestmove and the infos per depth and multipv.
+
+        stop_when is called with the infos whenever a depth is completed and stops the
+        search once it returns True. Infos of the interrupted depth are dropped then.
+        """
+        if stop_when is None:
+            self.write('go {}\n'.format(' '.join(str(item) for key_value in limits.items() for item in key_value)))
+            return parse_search_output(self.read('bestmove'))
+
+        multipv = int(self.sent_options.get('multipv', 1))
         bestmove = None
-        infos = defaultdict(dict)
-        KEYWORDS = {'depth': int, 'seldepth': int, 'multipv': int, 'nodes': int,
-                    'nps': int, 'time': int, 'score': list, 'pv': list}
-
-        for line in self.read('bestmove'):
-            items = line.split()
-            if not items:
-                continue
-            elif items[0] == 'bestmove':
-                bestmove = items[1]
-            elif items[0] == 'info' and len(items) > 1 and items[1] != 'string' and 'score' in items:
-                key = None
-                values = []
-                info = {}
-                for i in items[1:] + ['']:
-                    if not i or i in KEYWORDS:
-                        if key:
-                            if values and not issubclass(KEYWORDS[key], Iterable):
-                                values = values[0]
-                            info[key] = KEYWORDS[key](values)
-                        key = i
-                        values = []
-                    else:
-                        values.append(i)
-                infos[info.get('depth')][info.get('multipv', 1)] = info
-        infos = [[infos[d][m] for m in sorted(infos[d].keys())] for d in sorted(infos.keys())]
-        return bestmove, infos
+        infos = {}
+        stopped = False
+        for record in self.go_stream(**limits):
+            if 'bestmove' in record:
+                bestmove = record['bestmove']
+            elif not stopped:
+                depth_infos = infos.setdefault(record['depth'], {})
+                depth_infos[record['multipv']] = record
+                if len(depth_infos) == multipv and stop_when(_sorted_infos(infos)):
+                    self.stop()
+                    stopped = True
+        return bestmove, _sorted_infos(infos)
+
+    def go_stream(self, **limits):
+        """Run go and yield the parsed info records as the engine prints them.
+
+        The last record is {'bestmove': move}. Closing the generator early stops the search.
+        """
+        self.write('go {}\n'.format(' '.join(str(item) for key_value in limits.items() for item in key_value)))
+        finished = False
+        try:
+            while True:
+                line = self.process.stdout.readline()
+                if not line and self.process.poll() is not None:
+                    finished = True
+                    return
+                if line.startswith('bestmove'):
+                    finished = True
+                    yield {'bestmove': line.split()[1]}
+                    return
+                info = parse_info(line)
+                if info:
+                    yield info
+        finally:
+            if not finished:
+                self.stop()
+                self.read('bestmove')
+
+    def search(self, timeout=None, stop_when=None, **limits):
+        """Run go with the given limits, but stop the search after timeout seconds.
+
+        Returns a SearchResult whose timed_out flag tells whether the deadline was hit.
+        """
+        if timeout is None:
+            return SearchResult(*self.go(stop_when, **limits), False)
+        state = {'running': True, 'timed_out': False}
+        timer = threading.Timer(max(timeout, 0), self._deadline, args=[state])
+        timer.daemon = True
+        timer.start()
+        try:
+            bestmove, infos = self.go(stop_when, **limits)
+        finally:
+            timer.cancel()
+            with self.deadline_lock:
+                state['running'] = False
+        return SearchResult(bestmove, infos, state['timed_out'])
+
+    def _deadline(self, state):
+        with self.deadline_lock:
+            # the search might have finished just before the timer fired
+            if state['running']:
+                state['timed_out'] = True
+                self.stop()
 
     def stop(self):
         self.write('stop\n')
@@ -89,6 +183,82 @@ class Engine():
         return output
 
 
+class AsyncEngine():
+    """asyncio counterpart of Engine, so one event loop can drive many engine processes.
+
+    Create instances with ``await AsyncEngine.create(args, options)``. Cancelling a task
+    awaiting go stops the search, e.g., ``await asyncio.wait_for(engine.go(depth=20), 10)``.
+    """
+
+    def __init__(self, process, options=None):
+        self.process = process
+        self.options = options or {}
+        self.sent_options = {}
+
+    @classmethod
+    async def create(cls, args, options=None):
+        process = await asyncio.create_subprocess_exec(*args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        engine = cls(process, options)
+        await engine._init()
+        return engine
+
+    async def write(self, message):
+        self.process.stdin.write(message.encode())
+        await self.process.stdin.drain()
+
+    async def setoption(self, name, value):
+        if self.sent_options.get(name.lower()) == str(value):
+            return
+        self.options[name] = value
+        self.sent_options[name.lower()] = str(value)
+        await self.write('setoption name {} value {}\n'.format(name, value))
+
+    async def _init(self):
+        await self.write('uci\n')
+        await self.read('uciok')
+        for option, value in list(self.options.items()):
+            await self.setoption(option, value)
+
+    async def newgame(self):
+        await self.write('ucinewgame\n')
+        await self.write('isready\n')
+        await self.read('readyok')
+
+    async def position(self, fen=None, moves=None):
+        sfen = 'fen {}'.format(fen) if fen else 'startpos'
+        moves = 'moves {}'.format(' '.join(moves)) if moves else ''
+        await self.write('position {} {}\n'.format(sfen, moves))
+
+    async def go(self, **limits):
+        await self.write('go {}\n'.format(' '.join(str(item) for key_value in limits.items() for item in key_value)))
+        try:
+            lines = await self.read('bestmove')
+        except asyncio.CancelledError:
+            # leave the engine idle and in sync before propagating the cancellation
+            await self.stop()
+            await self.read('bestmove')
+            raise
+        return parse_search_output(lines)
+
+    async def stop(self):
+        await self.write('stop\n')
+
+    async def quit(self):
+        await self.write('quit\n')
+        await self.process.wait()
+
+    async def read(self, keyword):
+        output = []
+        while True:
+            line = (await self.process.stdout.readline()).decode()
+            if not line:
+                break
+            output.append(line)
+            if line.startswith(keyword):
+                break
+        return output
+
+
 if __name__ == '__main__':
     import sys
     e = Engine(sys.argv[1:])